@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""
+Generate backgrounds for several screen geometries in one run.
+
+The manifest is JSON:
+
+    {
+        "input_dir": "/Users/kyl/Copy/Wallpapers/InRotation",
+        "targets": [
+            {
+                "width": 1280, "height": 778,
+                "out_dir": "/Users/kyl/Copy/Wallpapers/SplitScreenBGs",
+                "ratios": [["full", 1, 1], ["tall", 0.5, 1], "custom"]
+            },
+            ...
+        ]
+    }
+
+A ratio given as a bare prefix takes its size from the existing
+<out_dir>/<prefix>.jpg, like splitscreenbgs.py --prefixes does. Each prefix
+uses the same source image for every geometry, so every source is decoded
+once and fitted to all of its targets in one worker.
+"""
+
+import json
+import time
+import splitscreenbgs as ss
+
+
+def load_manifest(path):
+    with open(path) as f:
+        return json.load(f)
+
+def target_sizes(target):
+    """Yield (prefix, (width, height)) for each ratio of a manifest target."""
+    width, height = target['width'], target['height']
+    for ratio in target.get('ratios') or ss.DEFAULT_RATIOS:
+        if isinstance(ratio, basestring):
+            size = ss.get_size_from_image(ratio, target['out_dir'])
+            if not size:
+                print("Error: can't get size for {}".format(ratio))
+                continue
+            yield ratio, tuple(size)
+        else:
+            prefix, w_ratio, h_ratio = ratio
+            yield prefix, (int(width*float(w_ratio)),
+                           int(height*float(h_ratio)))
+
+def build_queue(manifest, input_dir=None):
+    """
+    Returns a list of (source, [(size, out_file), ...]) jobs, one per
+    distinct source image.
+    """
+    input_dir = input_dir or manifest['input_dir']
+    by_prefix = {}
+    for target in manifest['targets']:
+        for prefix, size in target_sizes(target):
+            out_file = '{}/{}.jpg'.format(target['out_dir'], prefix)
+            by_prefix.setdefault(prefix, []).append((size, out_file))
+
+    jobs = {}
+    for prefix, outputs in by_prefix.items():
+        min_width = max(s[0] for s, o in outputs)
+        min_height = max(s[1] for s, o in outputs)
+        source = ss.choose_pic(input_dir, min_width, min_height)
+        if not source:
+            print("No images in {} large enough for {} ({}x{})".format(
+                input_dir, prefix, min_width, min_height))
+            continue
+        jobs.setdefault(source, []).extend(outputs)
+
+    return jobs.items()
+
+def render_source(args):
+    """Decode one source and write every output that uses it."""
+    source, outputs, threshhold = args
+    errors = []
+    written = 0
+    from PIL import Image
+    try:
+        im = Image.open(source)
+        im.load()
+    except IOError as e:
+        return source, 0, ["\tError reading {}: {}".format(source, e)]
+
+    for size, out_file in outputs:
+        try:
+            ss.fit_bg(im, size, threshhold, file=source).save(out_file)
+        except ss.GenerateImageError as e:
+            errors.append("\tError generating {}: {}".format(out_file,
+                                                              e.message))
+        except Exception as e:
+            errors.append("\tError saving image to {}: {}".format(out_file,
+                                                                  e.message))
+        else:
+            written += 1
+
+    return source, written, errors
+
+def run_queue(jobs, threshhold=3000, processes=None):
+    from multiprocessing import Pool
+    from random import seed
+
+    start = time.time()
+    written = 0
+    pool = Pool(processes, initializer=seed)
+    tasks = [(source, outputs, threshhold) for source, outputs in jobs]
+    for source, count, errors in pool.imap_unordered(render_source, tasks):
+        print("{} -> {} image(s)".format(source, count))
+        for e in errors:
+            print(e)
+        written += count
+    pool.close()
+    pool.join()
+
+    elapsed = time.time() - start
+    print('Wrote {} image(s) from {} source(s) in {:.2f}s ({:.1f} images/sec)'
+          .format(written, len(jobs), elapsed,
+                  written / elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    usage = "Usage: %prog [options] manifest.json"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-i', '--input-dir',
+                      help="Picture directory, overrides the manifest")
+    parser.add_option('-j', '--jobs', type='int',
+                      help="Number of worker processes, defaults to CPU count")
+    parser.add_option('-t', '--threshhold', type='int', default=3000,
+                      help="Width or height beyond which image should be resized"
+                           " instead of cropped")
+    options, args = parser.parse_args()
+
+    if not len(args) == 1:
+        parser.error("%prog takes exactly 1 argument")
+
+    manifest = load_manifest(args[0])
+    jobs = build_queue(manifest, options.input_dir)
+    if not jobs:
+        print('Nothing to generate')
+        exit()
+
+    run_queue(jobs, options.threshhold, options.jobs)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""
+Time each stage of csv-to-psql.py against a generated CSV and print the
+results as JSON, so runs from different versions can be compared.
+
+Without --db the load stages feed a fake psql that discards its input,
+which measures everything on the client side of the pipe.
+"""
+
+import csv, imp, json, os, platform, random, shutil, sys, tempfile, time
+from datetime import date, timedelta
+from subprocess import call, Popen, PIPE
+
+here = os.path.dirname(os.path.abspath(__file__))
+c2p = imp.load_source('csv_to_psql', os.path.join(here, 'csv-to-psql.py'))
+
+# reads stdin unless given a -c statement, like psql
+FAKE_PSQL = ['sh', '-c',
+             'for a; do [ "$a" = -c ] && exit; done; cat >/dev/null', 'psql']
+QUOTING = ('none', 'some', 'all', 'newlines')
+
+
+def generate_csv(path, rows, columns, quoting='some', seed=0):
+    """
+    Write ``rows`` rows of ``columns`` columns cycling through integer,
+    numeric, boolean, date and text values. ``quoting`` is one of QUOTING:
+    text never needs quotes, sometimes has commas, is always quoted, or
+    sometimes has newlines.
+    """
+    rand = random.Random(seed)
+    day = date(2000, 1, 1)
+    words = ['alpha', 'beta', 'gamma', 'delta', 'epsilon']
+    sep = {'none': ' ', 'some': ', ', 'all': ' ', 'newlines': '\n'}[quoting]
+    makers = [
+        lambda i: i,
+        lambda i: '%.2f' % rand.uniform(-1000, 1000),
+        lambda i: rand.choice(('true', 'false')),
+        lambda i: (day + timedelta(days=rand.randint(0, 9000))).isoformat(),
+        lambda i: (rand.random() < .2 and sep or ' ').join(
+            rand.sample(words, 3)),
+    ]
+    f = open(path, 'wb')
+    w = csv.writer(f, quoting=quoting == 'all' and csv.QUOTE_ALL
+                   or csv.QUOTE_MINIMAL)
+    w.writerow(['%d Column %d' % (c, c) for c in range(columns)])
+    for i in xrange(rows):
+        w.writerow([makers[c % len(makers)](i) for c in range(columns)])
+    f.close()
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
+
+def best_of(repeat, func, *args, **kwargs):
+    return min(timed(func, *args, **kwargs) for i in range(repeat))
+
+def parse(path):
+    for row in csv.reader(open(path, 'rb')):
+        pass
+
+def variablize_header(path, times=1000):
+    header = open(path, 'rb').readline().split(',')
+    for i in xrange(times):
+        map(c2p.variablize, header)
+
+def append_fresh(db, path, table, stdout=None):
+    """
+    A first --append run into a table that doesn't exist yet, as on an
+    empty database. Raises PsqlError if it fails.
+    """
+    call(c2p.PSQL + ['-q','-d',db,'-c','drop table if exists %s;' % table],
+         stdout=stdout)
+    state = tempfile.mkdtemp()
+    try:
+        c2p.incremental_csv_psql(db, path, table, progress=False,
+                                 state_path=os.path.join(state, 'state.json'),
+                                 stdout=stdout)
+    finally:
+        shutil.rmtree(state)
+
+def git_version():
+    try:
+        out = Popen(['git', 'describe', '--always', '--dirty'], cwd=here,
+                    stdout=PIPE, stderr=PIPE).communicate()[0]
+    except OSError:
+        return None
+    return out.strip() or None
+
+def run(path, rows, jobs=4, repeat=3, db=None, sample=1000):
+    """Returns {stage: {seconds, rows_per_sec}}, best of ``repeat`` runs."""
+    if not db:
+        c2p.PSQL = FAKE_PSQL
+        db = 'bench'
+    # keep psql's echo out of the report on our stdout
+    devnull = open(os.devnull, 'w')
+    table = 'bench_csv_to_psql'
+    # (name, rows processed, function, args...)
+    stages = [
+        ('variablize_x1000', None, variablize_header, path),
+        ('parse', rows, parse, path),
+        ('split', rows, c2p.record_ranges, path, jobs),
+        ('infer_sample', min(rows, sample), c2p.infer_types, path, ',',
+         sample),
+        ('infer_full', rows, c2p.infer_types, path, ',', None, 1),
+        ('infer_full_parallel', rows, c2p.infer_types, path, ',', None, jobs),
+        ('load_stream', rows, c2p.stream_csv_psql, db, path, table, ',',
+         c2p.CHUNK_SIZE, False, None, devnull),
+        ('load_parallel', rows, c2p.parallel_csv_psql, db, path, table, ',',
+         jobs, c2p.CHUNK_SIZE, False, None, False, devnull),
+        ('load_append_fresh', rows, append_fresh, db, path,
+         table + '_append', devnull),
+    ]
+    results = {}
+    for stage in stages:
+        seconds = best_of(repeat, *stage[2:])
+        results[stage[0]] = {
+            'seconds': round(seconds, 6),
+            'rows_per_sec': stage[1] and seconds and round(stage[1] / seconds)
+                            or None,
+        }
+    return results
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option('-r', '--rows', type='int', default=100000, help='rows to generate')
+    parser.add_option('-c', '--columns', type='int', default=10, help='columns to generate')
+    parser.add_option('-q', '--quoting', choices=QUOTING, default='some', help='one of %s' % ', '.join(QUOTING))
+    parser.add_option('-j', '--jobs', type='int', default=4, help='processes or connections for parallel stages')
+    parser.add_option('-n', '--repeat', type='int', default=3, help='runs per stage, the fastest is reported')
+    parser.add_option('-d', '--db', help='load into this database with the real psql instead of a fake sink')
+    parser.add_option('-f', '--file', default='/tmp/bench-csv-to-psql.csv', help='where to write the generated csv')
+    parser.add_option('-o', '--output', help='write JSON here instead of stdout')
+    parser.add_option('-k', '--keep', action='store_true', help='keep the generated csv')
+    (options, args) = parser.parse_args()
+
+    generate_csv(options.file, options.rows, options.columns, options.quoting)
+    report = {
+        'version': git_version(),
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': {
+            'rows': options.rows,
+            'columns': options.columns,
+            'quoting': options.quoting,
+            'jobs': options.jobs,
+            'repeat': options.repeat,
+            'bytes': os.path.getsize(options.file),
+            'sink': options.db and 'psql' or 'fake',
+        },
+        'stages': run(options.file, options.rows, options.jobs,
+                      options.repeat, options.db),
+    }
+    if not options.keep:
+        os.remove(options.file)
+
+    out = options.output and open(options.output, 'w') or sys.stdout
+    json.dump(report, out, indent=2, sort_keys=True)
+    out.write('\n')
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+"""
+Time how long each command line script takes to start, cold (no compiled
+bytecode for this repo's modules and an empty HOME) and warm, and record
+which heavy optional modules each one imported. Prints JSON.
+
+With --baseline, compares against an earlier run's JSON and exits 1 if any
+script got slower by more than the tolerance, failed, or imports a heavy
+module on a path that shouldn't need it.
+"""
+
+import glob, json, os, platform, shutil, sys, tempfile, time
+from subprocess import Popen, PIPE
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# name: script and arguments, all paths that must not touch the network
+# or need a heavy module
+ENTRY_POINTS = {
+    'splitscreenbgs': ['splitscreenbgs.py', '--help'],
+    'batchbgs': ['batchbgs.py', '--help'],
+    'bgpool': ['bgpool.py', '--help'],
+    'bgdaemon': ['bgdaemon.py', '--help'],
+    'iterm-cycle-bgs': ['iterm-cycle-bgs.py', '--help'],
+    'iterm-cycle-bgs-18': ['iterm-cycle-bgs-18.py', '--help'],
+    'koreanwod': ['koreanwod.py', '--help'],
+    'koreanwod-offline': ['koreanwod.py', '-k', '-o'],
+    'gettimes': ['gettimes.py', '--help'],
+    'csv-to-psql': ['csv-to-psql.py', '--help'],
+    'colorize': ['colorize.py', '-f', 'red', 'text'],
+    'rgbtohsl': ['rgbtohsl.py', 'ff8000'],
+    'x256': ['x256.py', '-w', '80'],
+}
+HEAVY = ('PIL', 'appscript', 'feedparser', 'pyquery', 'lxml', 'numpy',
+         'pyarrow', 'urllib2')
+
+# runs a script as __main__, then writes the heavy modules it imported to
+# the file named by the first argument
+PROBE = """
+import json, runpy, sys
+out, heavy = sys.argv[1], sys.argv[2].split(',')
+sys.argv = sys.argv[3:]
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+finally:
+    json.dump(sorted(m for m in heavy if m in sys.modules), open(out, 'w'))
+"""
+
+
+def git_version():
+    try:
+        out = Popen(['git', 'describe', '--always', '--dirty'], cwd=here,
+                    stdout=PIPE, stderr=PIPE).communicate()[0]
+    except OSError:
+        return None
+    return out.strip() or None
+
+def clear_bytecode():
+    for path in glob.glob(os.path.join(here, '*.pyc')):
+        os.remove(path)
+
+def timed_run(argv, env):
+    """Seconds to run ``argv`` to completion, and its exit status."""
+    devnull = open(os.devnull, 'r+')
+    start = time.time()
+    status = Popen(argv, cwd=here, env=env, stdin=devnull, stdout=devnull,
+                   stderr=devnull).wait()
+    return time.time() - start, status
+
+def heavy_imports(argv, env):
+    fd, out = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        devnull = open(os.devnull, 'r+')
+        Popen([sys.executable, '-c', PROBE, out, ','.join(HEAVY)] + argv,
+              cwd=here, env=env, stdin=devnull, stdout=devnull,
+              stderr=devnull).wait()
+        try:
+            return json.load(open(out))
+        except ValueError:
+            return None
+    finally:
+        os.remove(out)
+
+def run(repeat=5):
+    """
+    Returns {name: {cold, warm, status, heavy}}, warm being the best of
+    ``repeat`` runs.
+    """
+    results = {}
+    for name, args in sorted(ENTRY_POINTS.items()):
+        home = tempfile.mkdtemp()
+        env = dict(os.environ, HOME=home)
+        argv = [sys.executable] + args
+        try:
+            clear_bytecode()
+            cold, status = timed_run(argv, env)
+            warm = min(timed_run(argv, env)[0] for i in range(repeat))
+            results[name] = {
+                'cold': round(cold, 4),
+                'warm': round(warm, 4),
+                'status': status,
+                'heavy': heavy_imports(args, env),
+            }
+        finally:
+            shutil.rmtree(home)
+    return results
+
+def regressions(results, baseline, tolerance=0.25, slack=0.01):
+    """
+    Messages for scripts that failed, import a heavy module, or are slower
+    than ``baseline`` by more than ``tolerance`` plus ``slack`` seconds.
+    """
+    problems = []
+    for name, r in sorted(results.items()):
+        if r['status']:
+            problems.append('{} exited with {}'.format(name, r['status']))
+        if r['heavy']:
+            problems.append('{} imports {}'.format(name, ', '.join(r['heavy'])))
+        old = baseline.get(name)
+        if not old:
+            continue
+        for kind in ('cold', 'warm'):
+            limit = old[kind] * (1 + tolerance) + slack
+            if r[kind] > limit:
+                problems.append('{} {} start took {:.3f}s, baseline {:.3f}s'
+                                .format(name, kind, r[kind], old[kind]))
+    return problems
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option('-n', '--repeat', type='int', default=5, help='warm runs per script, the fastest is reported')
+    parser.add_option('-b', '--baseline', help='fail on regressions against this earlier JSON output')
+    parser.add_option('-t', '--tolerance', type='float', default=0.25, help='allowed slowdown as a fraction of the baseline')
+    parser.add_option('-o', '--output', help='write JSON here instead of stdout')
+    (options, args) = parser.parse_args()
+
+    report = {
+        'version': git_version(),
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': {'repeat': options.repeat},
+        'scripts': run(options.repeat),
+    }
+
+    out = options.output and open(options.output, 'w') or sys.stdout
+    json.dump(report, out, indent=2, sort_keys=True)
+    out.write('\n')
+
+    if options.baseline:
+        baseline = json.load(open(options.baseline))['scripts']
+        problems = regressions(report['scripts'], baseline, options.tolerance)
+        for p in problems:
+            sys.stderr.write(p + '\n')
+        if problems:
+            sys.exit(1)
+    elif any(r['status'] or r['heavy'] for r in report['scripts'].values()):
+        sys.exit(1)
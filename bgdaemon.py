@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+"""
+A resident process for the background scripts. It keeps the image index,
+the last few decoded pictures and a worker pool warm, and serves change,
+generate and list requests over a Unix socket, one JSON object per line
+each way.
+
+splitscreenbgs.py and the iterm-cycle-bgs scripts try the daemon first and
+do the work themselves when it isn't running, so starting it is optional.
+"""
+
+import json
+import os
+import socket
+import sys
+
+SOCKET_PATH = os.path.expanduser('~/.bgdaemon.sock')
+DECODE_CACHE_BYTES = 64 * 1024 * 1024 # decoded pixels kept for repeat renders
+JOBS = 2
+TIMEOUT = 5 # seconds to wait for a reply before working in-process
+
+
+def call(op, socket_path=SOCKET_PATH, timeout=TIMEOUT, **params):
+    """
+    Send one request to the daemon and return its reply, a dict with
+    either the result or an 'error' message. Returns None when no daemon
+    is listening or it doesn't answer within ``timeout`` seconds, such as
+    while it works through a long request, so callers can fall back to
+    working in-process. A ``timeout`` of None waits for the reply.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect(socket_path)
+        except socket.error:
+            return None
+        params['op'] = op
+        sock.sendall(json.dumps(params) + '\n')
+        line = sock.makefile('rb').readline()
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+    return json.loads(line) if line else None
+
+def _native(obj):
+    # json gives unicode, the index and glob patterns expect byte strings
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj, list):
+        return [_native(o) for o in obj]
+    if isinstance(obj, dict):
+        return dict((_native(k), _native(v)) for k, v in obj.items())
+    return obj
+
+
+def _covers(decoded, size, threshhold):
+    # whether a reduced decode still has the pixels a background needs
+    import splitscreenbgs as ss
+    need = ss.resize_target(decoded.source_size, size, threshhold) \
+           or decoded.source_size
+    return decoded.size[0] >= need[0] and decoded.size[1] >= need[1]
+
+class DecodeCache(object):
+    """
+    The last pictures opened, keyed by path and mtime and decoded at the
+    reduced scale their backgrounds need, up to ``max_bytes`` of pixels.
+    """
+    def __init__(self, max_bytes=DECODE_CACHE_BYTES):
+        from collections import OrderedDict
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+
+    def open(self, path, size, threshhold=None):
+        """A splitscreenbgs.DecodedImage of ``path`` for a ``size`` background."""
+        import splitscreenbgs as ss
+        key = (path, os.path.getmtime(path))
+        decoded = self.images.pop(key, None)
+        if decoded is None or not _covers(decoded, size, threshhold):
+            decoded = ss.DecodedImage(path, [size], threshhold, draft=True)
+        self.images[key] = decoded
+        # decodes are L or RGB, one byte per letter of the mode
+        used = lambda d: d.size[0] * d.size[1] * len(d.mode)
+        while sum(used(d) for d in self.images.values()) > self.max_bytes:
+            self.images.popitem(last=False)
+        return decoded
+
+
+def _fill(args):
+    """Top up one background pool in a worker, then evict as bgpool.py does."""
+    import bgpool
+    input_dir, out_dir, prefix, size, count, threshhold, max_bytes = args
+    pool = bgpool.BackgroundPool(out_dir, prefix, size, count)
+    try:
+        pool.fill(input_dir, threshhold)
+        bgpool.evict(out_dir, max_bytes, keep=pool.directory)
+    except Exception as e:
+        return str(e)
+
+
+class Daemon(object):
+    def __init__(self, jobs=JOBS):
+        from multiprocessing import Pool
+        from random import seed
+        # fork the workers before the index is opened so none of them
+        # inherit its sqlite connection
+        self.workers = Pool(jobs, initializer=seed)
+        self.images = DecodeCache()
+        self.filling = set()
+
+    def refill(self, pool, input_dir, threshhold):
+        import bgpool
+        if pool.directory in self.filling:
+            return
+        self.filling.add(pool.directory)
+        self.workers.apply_async(
+            _fill, [(input_dir, pool.out_dir, pool.prefix, pool.size,
+                     pool.count, threshhold, bgpool.POOL_MAX_BYTES)],
+            callback=lambda result: self.filling.discard(pool.directory))
+
+    def change(self, args):
+        """bgpool.render_bg() with the decode cache and warm workers."""
+        import bgpool
+        input_dir, threshhold = args[0], args[4]
+        refill = lambda pool: self.refill(pool, input_dir, threshhold)
+        return {'source': bgpool.render_bg(*args, open_image=self.images.open,
+                                           refill=refill)}
+
+    def generate(self, args):
+        """splitscreenbgs.generate() on the worker pool."""
+        import splitscreenbgs as ss
+        return {'lines': list(ss.generate(*args, pool=self.workers))}
+
+    def list(self, out_dir):
+        import splitscreenbgs as ss
+        return {'lines': list(ss.size_lines(out_dir))}
+
+    def handle(self, request):
+        op = request.pop('op', None)
+        try:
+            if op == 'change':
+                return self.change(request['args'])
+            if op == 'generate':
+                return self.generate(request['args'])
+            if op == 'list':
+                return self.list(request['out_dir'])
+            if op == 'ping':
+                return {'pid': os.getpid()}
+            return {'error': 'Unknown request {}'.format(op)}
+        except Exception as e:
+            return {'error': e.message or str(e)}
+
+    def close(self):
+        self.workers.terminate()
+
+
+def serve(socket_path=SOCKET_PATH, jobs=JOBS):
+    """Answer requests on ``socket_path`` one at a time until a stop request."""
+    if call('ping', socket_path):
+        sys.exit('Already running on {}'.format(socket_path))
+    if os.path.exists(socket_path):
+        os.remove(socket_path) # left by a daemon that died
+
+    daemon = Daemon(jobs)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(socket_path)
+        os.chmod(socket_path, 0600)
+        server.listen(16)
+        while True:
+            conn = server.accept()[0]
+            conn.settimeout(5) # for the request, not the work
+            try:
+                request = _native(json.loads(conn.makefile('rb').readline()))
+                if request.get('op') == 'stop':
+                    conn.sendall(json.dumps({'pid': os.getpid()}) + '\n')
+                    break
+                conn.sendall(json.dumps(daemon.handle(request)) + '\n')
+            except (socket.error, ValueError):
+                pass
+            finally:
+                conn.close()
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        daemon.close()
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    usage = "Usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-s', '--socket', default=SOCKET_PATH,
+                      help="Unix socket to listen on, default %default")
+    parser.add_option('-j', '--jobs', type='int', default=JOBS,
+                      help="Worker processes for generating and pool refills")
+    parser.add_option('--stop', action='store_true',
+                      help="Stop the running daemon")
+    options, args = parser.parse_args()
+
+    if options.stop:
+        if not call('stop', options.socket):
+            sys.exit('Not running')
+    else:
+        try:
+            serve(options.socket, options.jobs)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""
+Pools of pre-rendered backgrounds so changing a background is just a rename.
+
+Each prefix and size gets a directory under <out_dir>/.pool holding up to
+``count`` ready images. Taking one starts a detached ``bgpool.py`` process
+that renders replacements, then evicts the least recently used pools while
+the total exceeds the size limit.
+"""
+
+import os
+import sys
+import time
+from glob import glob
+from shutil import rmtree
+from subprocess import Popen
+import splitscreenbgs as ss
+
+POOL_SIZE = 3
+POOL_MAX_BYTES = 200 * 1024 * 1024
+LOCK_TIMEOUT = 600 # seconds before a refill lock is considered stale
+
+
+class BackgroundPool(object):
+    def __init__(self, out_dir, prefix, size, count=POOL_SIZE):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.size = tuple(size)
+        self.count = count
+        self.directory = '{}/.pool/{}-{}x{}'.format(out_dir, prefix, *self.size)
+
+    def ready(self):
+        """Finished images, oldest first."""
+        return sorted(glob('{}/*.jpg'.format(self.directory)))
+
+    def take(self, dest):
+        """
+        Move the oldest ready image to ``dest``. Returns the name of the
+        source picture it was made from, or None if the pool is empty.
+        """
+        for path in self.ready():
+            try:
+                os.rename(path, dest)
+            except OSError:
+                continue # taken by another session
+            touch('{}/.used'.format(self.directory))
+            return os.path.basename(path).split('_', 1)[1]
+
+    def fill(self, input_dir, threshhold=3000):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        if not self._lock():
+            return
+        try:
+            for i in range(self.count - len(self.ready())):
+                source = ss.choose_pic(input_dir, *self.size)
+                if not source:
+                    print("No images in {} match parameters".format(input_dir))
+                    break
+                name = '{}/{:.6f}_{}'.format(self.directory, time.time(),
+                                             os.path.basename(source))
+                try:
+                    im = ss.make_bg(source, self.size, threshhold)
+                    im.save(name + '.tmp', 'JPEG')
+                except Exception as e:
+                    print("Error generating image from {}: {}".format(
+                        source, e))
+                else:
+                    os.rename(name + '.tmp', name)
+        finally:
+            os.remove(self._lockfile())
+
+    def refill_async(self, input_dir, threshhold=3000, max_bytes=POOL_MAX_BYTES):
+        """Start a detached process to top up this pool."""
+        if os.path.exists(self._lockfile()):
+            return
+        script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        args = [sys.executable, script, '-n', str(self.count),
+                '-m', str(max_bytes)]
+        if threshhold is not None:
+            args += ['-t', str(threshhold)]
+        args += [input_dir, self.out_dir, self.prefix,
+                 '{}x{}'.format(*self.size)]
+        devnull = open(os.devnull, 'w')
+        Popen(args, stdout=devnull, stderr=devnull, close_fds=True,
+              preexec_fn=os.setsid)
+
+    def _lockfile(self):
+        return '{}/.lock'.format(self.directory)
+
+    def _lock(self):
+        lockfile = self._lockfile()
+        try:
+            if time.time() - os.path.getmtime(lockfile) > LOCK_TIMEOUT:
+                os.remove(lockfile)
+        except OSError:
+            pass
+        try:
+            os.close(os.open(lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError:
+            return False
+        return True
+
+
+def touch(path):
+    with open(path, 'a'):
+        os.utime(path, None)
+
+def last_used(pool_dir):
+    for path in ('{}/.used'.format(pool_dir), pool_dir):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            pass
+    return 0
+
+def evict(out_dir, max_bytes=POOL_MAX_BYTES, keep=None):
+    """
+    Delete whole pools, least recently used first, until all pools in
+    ``out_dir`` fit in ``max_bytes``. The pool directory ``keep`` is spared.
+    """
+    pools = sorted(glob('{}/.pool/*'.format(out_dir)), key=last_used)
+    sizes = dict((p, sum(os.path.getsize(f) for f in glob('{}/*'.format(p))))
+                 for p in pools)
+    total = sum(sizes.values())
+    for p in pools:
+        if total <= max_bytes:
+            break
+        if p == keep:
+            continue
+        rmtree(p, ignore_errors=True)
+        total -= sizes[p]
+
+def render_bg(input_dir, out_dir, prefix, dest, threshhold=None,
+              pool_size=POOL_SIZE, filename=None, open_image=None,
+              refill=None):
+    """
+    Write a new background for ``prefix`` to ``dest`` and return the path
+    of the picture it came from. A ready image from the prefix's pool is
+    used if there is one, and the pool is topped up by ``refill(pool)``,
+    by default a detached bgpool.py. Otherwise a picture is chosen and
+    rendered now, from ``open_image(path, size, threshhold)`` if given,
+    which returns a splitscreenbgs.DecodedImage. Raises GenerateImageError
+    with a message to show if that fails.
+    """
+    size = ss.get_size_from_image(prefix, out_dir)
+    if not size:
+        raise ss.GenerateImageError("\tCan't get size for {}".format(prefix))
+    if pool_size and not filename:
+        pool = BackgroundPool(out_dir, prefix, size, pool_size)
+        source = pool.take(dest)
+        if refill:
+            refill(pool)
+        else:
+            pool.refill_async(input_dir, threshhold)
+        if source:
+            return '{}/{}'.format(input_dir, source)
+
+    pattern = filename and '{{}}/{}'.format(filename) or None
+    path = ss.choose_pic(input_dir, size[0], size[1], pattern=pattern)
+    if not path:
+        raise Exception("\tNo images in {} match parameters".format(input_dir))
+
+    try:
+        if open_image:
+            decoded = open_image(path, size, threshhold)
+            im = ss.fit_bg(decoded.open(), size, threshhold, file=path,
+                           source_size=decoded.source_size)
+        else:
+            im = ss.make_bg(path, size, threshhold)
+    except ss.GenerateImageError as e:
+        raise ss.GenerateImageError(
+            "\tError generating image: {}".format(e.message))
+    try:
+        im.save(dest)
+    except Exception as e:
+        raise ss.GenerateImageError(
+            "\tError saving image to {}: {}".format(dest, e.message))
+    return path
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    usage = "Usage: %prog [options] picture_dir out_dir prefix WIDTHxHEIGHT"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-n', '--count', type='int', default=POOL_SIZE,
+                      help="Number of ready images to keep")
+    parser.add_option('-t', '--threshhold', type='int', default=3000,
+                      help="Width or height beyond which image should be resized"
+                           " instead of cropped")
+    parser.add_option('-m', '--max-bytes', type='int', default=POOL_MAX_BYTES,
+                      help="Evict least recently used pools beyond this size")
+    options, args = parser.parse_args()
+
+    if not len(args) == 4:
+        parser.error("%prog takes exactly 4 arguments")
+
+    read_dir, out_dir, prefix, size = args
+    size = [int(n) for n in size.split('x')]
+    pool = BackgroundPool(out_dir, prefix, size, options.count)
+    pool.fill(read_dir, options.threshhold)
+    evict(out_dir, options.max_bytes, keep=pool.directory)
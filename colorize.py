@@ -1,77 +1,289 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import re
+import sys
+from rgbtohsl import hsltorgb
+
+COLORS = (
+    ('blu', '4', re.compile('^bl?u?e?$')),
+    ('cya', '6', re.compile('^cy?a?n?$')),
+    ('red', '1', re.compile('^re?d?$')),
+    ('blk', '0', re.compile('^bl?a?c?k$')),
+    ('grn', '2', re.compile('^gr?e?e?n?$')),
+    ('mag', '5', re.compile('^ma?g?e?n?t?a?$')),
+    ('whi', '7', re.compile('^wh?i?t?e?$')),
+    ('def', '', re.compile('^(no?r?m?a?l?|defa?u?l?t?)$')),
+    ('yel', '3', re.compile('^ye?l?l?o?w?$')),
+)
+
+# checked in this order, which decides overlaps like 'bl' (blink, not bold)
+VARIANTS = (
+    ('dim', '2', re.compile('^di?m?$')),
+    ('rev', '7', re.compile('^(r|i)(e|n)?v?e?r?s?')),
+    ('bnk', '5', re.compile('^(bnk|bk|bli?n?k?)$')),
+    ('bol', '1', re.compile('^bo?l?d?$')),
+    ('und', '4', re.compile('^un?d?e?r?l?i?n?e?$')),
+    ('def', '0', re.compile('^(no?r?m?a?l?|defa?u?l?t?)$')),
+)
+
+RESET = '\033[m'
+BUFSIZE = 64 * 1024
+TRUECOLOR = os.environ.get('COLORTERM') in ('truecolor', '24bit')
+
+HEX = re.compile('^#?([0-9a-fA-F]{2})([0-9a-fA-F]{2})([0-9a-fA-F]{2})$')
+TRIPLE = re.compile(r'^(rgb|hsl)?\(?\s*(\d+)%?\s*,\s*(\d+)%?\s*,\s*(\d+)%?\s*\)?$')
+
+# xterm's 256 colors: 16 system colors, a 6x6x6 cube, then 24 grays
+SYSTEM = (
+    (0, 0, 0), (205, 0, 0), (0, 205, 0), (205, 205, 0),
+    (0, 0, 238), (205, 0, 205), (0, 205, 205), (229, 229, 229),
+    (127, 127, 127), (255, 0, 0), (0, 255, 0), (255, 255, 0),
+    (92, 92, 255), (255, 0, 255), (0, 255, 255), (255, 255, 255),
+)
+LEVELS = (0, 95, 135, 175, 215, 255)
+PALETTE = SYSTEM + tuple((LEVELS[i // 36], LEVELS[i // 6 % 6], LEVELS[i % 6])
+                         for i in range(216)) \
+                 + tuple((v, v, v) for v in range(8, 248, 10))
+
+# resolved names, seeded with every canonical abbreviation
+_colors = dict((c, n) for c, n, p in COLORS)
+_variants = dict((v, n) for v, n, p in VARIANTS)
+_sgr = {}
+_nearest = None
+
+def parse_color(color_string):
+    """
+    An (r, g, b) tuple for hex (#ff8800), rgb(255,136,0), 255,136,0 or
+    hsl(32,100,50), otherwise None. Out of range values are clamped, and
+    hue wraps around.
+    """
+    match = HEX.match(color_string)
+    if match:
+        return tuple(int(c, 16) for c in match.groups())
+    match = TRIPLE.match(color_string)
+    if match:
+        kind, a, b, c = match.groups()
+        if kind == 'hsl':
+            a, b, c = int(a) % 360, min(int(b), 100), min(int(c), 100)
+            rgb = hsltorgb(a, b, c)
+        else:
+            rgb = (int(a), int(b), int(c))
+        return tuple(max(0, min(v, 255)) for v in rgb)
+
+def _nearest_cube_or_gray(r, g, b):
+    # the cube and gray ramp are evenly spread enough that the nearest
+    # entry is the nearest cube level per channel or the nearest gray
+    level = lambda v: min(range(6), key=lambda i: abs(LEVELS[i] - v))
+    cube = 16 + 36 * level(r) + 6 * level(g) + level(b)
+    gray = 232 + min(23, max(0, int(round(((r + g + b) / 3.0 - 8) / 10))))
+    dist = lambda i: sum((x - y) ** 2 for x, y in zip(PALETTE[i], (r, g, b)))
+    return cube if dist(cube) <= dist(gray) else gray
+
+def nearest_256(r, g, b):
+    """
+    Closest xterm-256 index (16-255; system colors vary by theme) from a
+    32x32x32 table built on first use, so each lookup is O(1).
+    """
+    global _nearest
+    if _nearest is None:
+        _nearest = bytearray(_nearest_cube_or_gray(x << 3 | 4, y << 3 | 4,
+                                                   z << 3 | 4)
+                             for x in range(32)
+                             for y in range(32)
+                             for z in range(32))
+    return _nearest[(r >> 3) << 10 | (g >> 3) << 5 | b >> 3]
+
+def extended_color(color_string, truecolor=TRUECOLOR):
+    """SGR color parameters after 38 or 48, or None for a basic color."""
+    rgb = parse_color(color_string)
+    if not rgb:
+        return None
+    if truecolor:
+        return '2;{};{};{}'.format(*rgb)
+    return '5;{}'.format(nearest_256(*rgb))
+
+def _lookup(table, patterns, name):
+    try:
+        return table[name]
+    except KeyError:
+        for c, n, p in patterns:
+            if p.match(name):
+                break
+        else:
+            n = None
+        table[name] = n
+        return n
 
 def color_number(color_string):
-    patterns = {
-        'def': ('', re.compile('^(no?r?m?a?l?|defa?u?l?t?)$')),
-        'blk': ('0', re.compile('^bl?a?c?k$')),
-        'red': ('1', re.compile('^re?d?$')),
-        'grn': ('2', re.compile('^gr?e?e?n?$')),
-        'yel': ('3', re.compile('^ye?l?l?o?w?$')),
-        'blu': ('4', re.compile('^bl?u?e?$')),
-        'mag': ('5', re.compile('^ma?g?e?n?t?a?$')),
-        'cya': ('6', re.compile('^cy?a?n?$')),
-        'whi': ('7', re.compile('^wh?i?t?e?$')),
-    }
-
-    for c,p in patterns.iteritems():
-        if p[1].match(color_string):
-            return p[0]
+    return _lookup(_colors, COLORS, color_string)
 
 def variant_number(variant_string):
-    patterns = {
-        'def': ('0', re.compile('^(no?r?m?a?l?|defa?u?l?t?)$')),
-        'bol': ('1', re.compile('^bo?l?d?$')),
-        'dim': ('2', re.compile('^di?m?$')),
-        'und': ('4', re.compile('^un?d?e?r?l?i?n?e?$')),
-        'bnk': ('5', re.compile('^(bnk|bk|bli?n?k?)$')),
-        'rev': ('7', re.compile('^(r|i)(e|n)?v?e?r?s?')),
-    }
-
-    for v,p in patterns.iteritems():
-        if p[1].match(variant_string):
-            return p[0]
-
-def colorize(text, fg='def', bg='def', var='def', bgalt=False, debug=False):
-    tpl = '\033[{color}m{text}\033[m'
+    return _lookup(_variants, VARIANTS, variant_string)
+
+def sgr(fg='def', bg='def', var='def', bgalt=False, truecolor=TRUECOLOR):
+    """
+    The SGR parameter string for a style, built once per combination.
+    Colors other than the basic names may be hex, rgb or hsl values; they
+    are sent as 24-bit color with ``truecolor``, else as the nearest of
+    the 256 xterm colors.
+    """
+    key = (fg, bg, var, bgalt, truecolor)
+    try:
+        return _sgr[key]
+    except KeyError:
+        pass
+
     fgc = color_number(fg)
     bgc = color_number(bg)
     vnm = variant_number(var)
+    fgx = fgc is None and extended_color(fg, truecolor)
+    bgx = bgc is None and extended_color(bg, truecolor)
 
-    if fgc:
+    if fgx:
+        whole = '{};38;{}'.format(vnm, fgx)
+    elif fgc:
         whole = '{};3{}'.format(vnm, fgc)
     else:
         whole = vnm
 
-    if bgc:
+    if bgx:
+        whole = '{};48;{}'.format(whole, bgx)
+    elif bgc:
         bgnm = '10' if bgalt else '4'
         whole = '{};{}{}'.format(whole, bgnm, bgc)
 
+    _sgr[key] = whole
+    return whole
+
+def colorize(text, fg='def', bg='def', var='def', bgalt=False, debug=False,
+             truecolor=TRUECOLOR):
+    whole = sgr(fg, bg, var, bgalt, truecolor)
+
     if debug:
         print whole
 
-    return tpl.format(color=whole, text=text)
+    return '\033[{}m{}\033[m'.format(whole, text)
+
+def colorize_all(texts, fg='def', bg='def', var='def', bgalt=False,
+                 truecolor=TRUECOLOR):
+    """Yield each of ``texts`` in one style, resolving the style once."""
+    prefix = '\033[{}m'.format(sgr(fg, bg, var, bgalt, truecolor))
+    for text in texts:
+        yield prefix + text + RESET
+
+def load_rules(path):
+    """
+    Read filter rules, one per line as ``<line|match> <style> <regex>``,
+    where style is ``fg[:bg[:var[:alt]]]`` and an empty part means default.
+    ``line`` rules color the whole line the regex is found in, ``match``
+    rules just the matched text. Blank lines and # comments are skipped.
+    """
+    rules = []
+    for line in open(path):
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        mode, style, pattern = line.rstrip('\r\n').split(None, 2)
+        if mode not in ('line', 'match'):
+            raise ValueError('Unknown rule mode {}'.format(mode))
+        fg, bg, var, alt = (style.split(':') + [''] * 4)[:4]
+        rules.append((mode, pattern, fg or 'def', bg or 'def', var or 'def',
+                      bool(alt)))
+    return rules
+
+def compile_rules(rules, truecolor=TRUECOLOR):
+    """
+    Combine rules into one regex with a named group per rule, earlier rules
+    winning. Returns the regex and the escape prefix for each group name.
+    Rule patterns should not use named groups of their own.
+    """
+    parts = []
+    prefixes = {}
+    for i, (mode, pattern, fg, bg, var, bgalt) in enumerate(rules):
+        name = '_{}'.format(i)
+        prefixes[name] = '\033[{}m'.format(sgr(fg, bg, var, bgalt,
+                                                 truecolor))
+        if mode == 'line':
+            # (?=.) stops it matching the empty end of a block
+            parts.append('(?P<{}>^(?=.).*?(?:{}).*$)'.format(name, pattern))
+        else:
+            parts.append('(?P<{}>{})'.format(name, pattern))
+    return re.compile('|'.join(parts), re.M), prefixes
+
+def colorize_stream(infile, outfile, rules, truecolor=TRUECOLOR,
+                    bufsize=BUFSIZE):
+    """
+    Copy ``infile`` to ``outfile`` applying ``rules``. Input is read with
+    os.read, so whatever is available (up to ``bufsize``) is colorized and
+    flushed at once, a block of whole lines at a time.
+    """
+    regex, prefixes = compile_rules(rules, truecolor)
+    sub = regex.sub
+    paint = lambda m: prefixes[m.lastgroup] + m.group() + RESET
+    fd = infile.fileno()
+    pending = ''
+    while True:
+        chunk = os.read(fd, bufsize)
+        if chunk:
+            data = pending + chunk
+            cut = data.rfind('\n') + 1
+            data, pending = data[:cut], data[cut:]
+        else:
+            data, pending = pending, ''
+        if data:
+            outfile.write(sub(paint, data))
+            outfile.flush()
+        if not chunk:
+            break
 
 if __name__ == '__main__':
     from optparse import OptionParser
-    usage="Usage: %prog --fg [fg] --bg [bg] --var [var] --bgalt 'text'"
+    usage="Usage: %prog --fg [fg] --bg [bg] --var [var] --bgalt 'text'\n" \
+          "       %prog --rules RULES_FILE < log\n" \
+          "       %prog --fg [fg] --bg [bg] --var [var] --bgalt --stdin < log"
     parser = OptionParser(usage=usage)
-    parser.add_option('-f', '--fg', help='foreground color', default='def')
-    parser.add_option('-b', '--bg', help='background color', default='def')
+    parser.add_option('-f', '--fg', default='def',
+                      help='foreground color: a name, #rrggbb, r,g,b or'
+                           ' hsl(h,s,l)')
+    parser.add_option('-b', '--bg', help='background color, as for --fg',
+                      default='def')
     parser.add_option('-v', '--var', help='variant style', default='def')
     parser.add_option('-a', '--bgalt', action='store_true', default=False,
                       help='use bright colors for backgroud')
+    parser.add_option('-t', '--truecolor', action='store_true',
+                      default=TRUECOLOR,
+                      help='send 24-bit color instead of the nearest of 256'
+                           ' (default from $COLORTERM)')
+    parser.add_option('-8', '--256', action='store_false', dest='truecolor',
+                      help='send the nearest of the 256 xterm colors')
+    parser.add_option('-r', '--rules',
+                      help='filter stdin, coloring lines or matches per the'
+                           ' rules in this file')
+    parser.add_option('-s', '--stdin', action='store_true', default=False,
+                      help='filter stdin, coloring every line')
     parser.add_option('-d', '--debug', action='store_true', default=False,
                       help='show color number used')
     options, args = parser.parse_args()
 
+    if options.rules or options.stdin:
+        if options.rules:
+            rules = load_rules(options.rules)
+        else:
+            rules = [('line', '', options.fg, options.bg, options.var,
+                      options.bgalt)]
+        try:
+            colorize_stream(sys.stdin, sys.stdout, rules, options.truecolor)
+        except KeyboardInterrupt:
+            pass
+        exit()
+
     if len(args) < 1:
         parser.error("You didn't provide a string of text to colorize")
 
     print(
         colorize(args[0], fg=options.fg, bg=options.bg, var=options.var,
-                 bgalt=options.bgalt, debug=options.debug)
+                 bgalt=options.bgalt, debug=options.debug,
+                 truecolor=options.truecolor)
     )
 
@@ -1,27 +1,425 @@
 #!/usr/bin/env python
 
-import re, os
-from subprocess import call
+import csv, json, re, os, sys, time
+from hashlib import sha1
+from itertools import islice
+from threading import Thread
+from subprocess import call, Popen, PIPE
 
-def load_csv_psql(db, infile, table, tmpdir='/tmp', delim=','):
-    tmpfile = '%s/%s' % (tmpdir, os.path.basename(infile))
-    call(['cp', infile, tmpdir])
+PSQL = ['psql'] # command prefix, swapped for a fake sink by the benchmark
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_TYPE = 'varchar(1000)'
+STATE_PATH = os.path.expanduser('~/.csv-to-psql.json')
+HASH_BYTES = 64 * 1024
 
-    columns = map(variablize, file(tmpfile).readline().split(','))
-    columns = map(lambda v: '%s varchar(1000)' % v, columns)
-    queries = [
-        'drop table %s;' % table,
-        'create table %s (%s);' % (table, ','.join(columns)),
-        "copy %s from '%s' with csv header delimiter '%s';" % (table, tmpfile, delim),
+INTEGER = re.compile(r'^\s*[-+]?\d+\s*$')
+NUMERIC = re.compile(r'^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$')
+BOOLEAN = re.compile(r'^\s*(t|f|true|false|y|n|yes|no|on|off)\s*$', re.I)
+DATE = r'\d{4}-(0[1-9]|1[0-2])-(0[1-9]|[12]\d|3[01])'
+TIME = r'([ T]([01]\d|2[0-3]):[0-5]\d(:[0-5]\d(\.\d+)?)?)?'
+TIMESTAMP = re.compile(r'^\s*%s%s\s*$' % (DATE, TIME))
+TIMESTAMPTZ = re.compile(r'^\s*%s%s\s*([-+]\d{2}(:?\d{2})?|Z)?\s*$' % (DATE, TIME))
+DATE = re.compile(r'^\s*%s\s*$' % DATE)
+
+class PsqlError(Exception):
+    pass
+
+# narrowest first; a column gets the first type every value matches
+TYPES = [
+    ('boolean', BOOLEAN.match),
+    ('integer', lambda v: INTEGER.match(v) and -2**31 <= int(v) < 2**31),
+    ('bigint', lambda v: INTEGER.match(v) and -2**63 <= int(v) < 2**63),
+    ('numeric', NUMERIC.match),
+    ('date', DATE.match),
+    ('timestamp', TIMESTAMP.match),
+    ('timestamp with time zone', TIMESTAMPTZ.match),
+]
+
+def table_queries(table, columns, types=None, unlogged=False):
+    """Returns the statements to run before and after loading data."""
+    types = types or [DEFAULT_TYPE] * len(columns)
+    columns = map(lambda v: '%s %s' % v, zip(columns, types))
+    before = [
+        'drop table if exists %s;' % table,
+        'create %stable %s (%s);' % (unlogged and 'unlogged ' or '', table,
+                                    ','.join(columns)),
+    ]
+    after = [
         'alter table %s add column id serial;' % table,
         'alter table %s add primary key (id);' % table,
     ]
-    for q in queries:
-        call(['psql','-a','-d',db,'-c',q])
+    return before, after
+
+def load_csv_psql(db, infile, table, tmpdir='/tmp', delim=',', types=None):
+    tmpfile = '%s/%s' % (tmpdir, os.path.basename(infile))
+    call(['cp', infile, tmpdir])
+
+    columns = map(variablize, file(tmpfile).readline().split(','))
+    before, after = table_queries(table, columns, types)
+    copy = "copy %s from '%s' with csv header delimiter '%s';" % (table, tmpfile, delim)
+    for q in before + [copy] + after:
+        call(PSQL + ['-a','-d',db,'-c',q])
 
     call(['rm', tmpfile])
 
 
+def stream_csv_psql(db, infile, table, delim=',', chunk_size=CHUNK_SIZE,
+                    progress=True, types=None, stdout=None):
+    """
+    Load ``infile`` through a single psql process with ``copy ... from
+    stdin``, reading it ``chunk_size`` bytes at a time. psql's output goes
+    to ``stdout``, a file, or ours by default. psql stops at the first
+    error, and PsqlError is raised.
+    """
+    f = file(infile, 'rb')
+    columns = map(variablize, f.readline().split(','))
+    f.seek(0)
+
+    before, after = table_queries(table, columns, types)
+    copy = "copy %s from stdin with csv header delimiter '%s';" % (table, delim)
+    psql = Popen(PSQL + ['-a','-v','ON_ERROR_STOP=1','-d',db], stdin=PIPE,
+                 stdout=stdout)
+
+    lines = 0
+    last = '\n'
+    start = reported = time.time()
+    try:
+        psql.stdin.write('\n'.join(before + [copy]) + '\n')
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            psql.stdin.write(chunk)
+            lines += chunk.count('\n')
+            last = chunk[-1]
+            if progress and time.time() - reported >= 1:
+                reported = time.time()
+                report_progress(lines - 1, reported - start)
+
+        if last != '\n':
+            psql.stdin.write('\n')
+            lines += 1
+        psql.stdin.write('\\.\n' + '\n'.join(after) + '\n')
+        psql.stdin.close()
+    except IOError:
+        pass # psql quit on an error, its exit status says so
+    f.close()
+    if psql.wait():
+        if progress:
+            sys.stderr.write('\n')
+        raise PsqlError('loading %s into %s failed' % (infile, table))
+
+    if progress:
+        report_progress(lines - 1, time.time() - start, end='\n')
+
+def parallel_csv_psql(db, infile, table, delim=',', processes=4,
+                      chunk_size=CHUNK_SIZE, progress=True, types=None,
+                      staging=False, stdout=None):
+    """
+    Split ``infile`` into record-aligned byte ranges and copy them in
+    concurrently, one psql process per range. With ``staging`` the ranges
+    go into an unlogged table that replaces ``table`` once all are loaded.
+    If any range fails, the rows that did load are removed and PsqlError
+    is raised.
+    The id column and primary key are added once, at the end. psql's
+    output goes to ``stdout`` as in stream_csv_psql().
+    """
+    columns = map(variablize, file(infile, 'rb').readline().split(','))
+    target = staging and '%s_staging' % table or table
+    before, after = table_queries(target, columns, types, unlogged=staging)
+    for q in before:
+        call(PSQL + ['-a','-d',db,'-c',q], stdout=stdout)
+
+    start = time.time()
+    results = []
+    def copy(a, b):
+        results.append(copy_range(db, infile, target, a, b, delim,
+                                  chunk_size, stdout=stdout))
+    threads = [Thread(target=copy, args=r)
+               for r in record_ranges(infile, processes, chunk_size)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    failed = len([status for lines, status in results if status])
+    if failed:
+        # the ranges that loaded committed on their own, don't leave them
+        # behind as a partial table
+        q = (staging and 'drop table %s;' or 'truncate %s;') % target
+        call(PSQL + ['-a','-d',db,'-c',q], stdout=stdout)
+        raise PsqlError('%d of %d ranges failed to load into %s'
+                        % (failed, len(results), target))
+
+    if staging:
+        before, after = table_queries(table, columns, types)
+        swap = [
+            before[0],
+            'alter table %s rename to %s;' % (target, table),
+            'alter table %s set logged;' % table,
+        ]
+        after = swap + after
+    for q in after:
+        call(PSQL + ['-a','-d',db,'-c',q], stdout=stdout)
+
+    if progress:
+        report_progress(sum(lines for lines, status in results),
+                        time.time() - start, end='\n')
+
+def copy_range(db, infile, table, start, end, delim=',', chunk_size=CHUNK_SIZE,
+               before=(), after=(), stdout=None):
+    """
+    Stream bytes ``start`` to ``end`` of ``infile`` into ``table``, running
+    ``before`` and ``after`` statements in the same session. Returns the
+    lines sent and psql's exit status, which is non-zero if any statement
+    failed; psql stops at the first error.
+    """
+    psql = Popen(PSQL + ['-q','-v','ON_ERROR_STOP=1','-d',db], stdin=PIPE,
+                 stdout=stdout)
+    f = file(infile, 'rb')
+    f.seek(start)
+    lines = 0
+    last = '\n'
+    try:
+        psql.stdin.write(''.join(q + '\n' for q in before))
+        psql.stdin.write("copy %s from stdin with csv delimiter '%s';\n"
+                         % (table, delim))
+        while start < end:
+            chunk = f.read(min(chunk_size, end - start))
+            if not chunk:
+                break
+            psql.stdin.write(chunk)
+            start += len(chunk)
+            lines += chunk.count('\n')
+            last = chunk[-1]
+
+        if last != '\n':
+            psql.stdin.write('\n')
+            lines += 1
+        psql.stdin.write('\\.\n')
+        psql.stdin.write(''.join(q + '\n' for q in after))
+        psql.stdin.close()
+    except IOError:
+        pass # psql quit on an error, its exit status says so
+    f.close()
+    return lines, psql.wait()
+
+def incremental_csv_psql(db, infile, table, delim=',', key=None,
+                         chunk_size=CHUNK_SIZE, progress=True, types=None,
+                         state_path=STATE_PATH, stdout=None):
+    """
+    Load only the rows appended to ``infile`` since the last run, inserting
+    them or, with ``key``, upserting on that column. The offset, row count,
+    key and a hash of the header plus the HASH_BYTES before the offset are
+    kept per file in ``state_path``; if the file or key no longer matches,
+    it is reloaded in full, with a unique index on ``key``. The state is
+    only saved once the rows are loaded. psql's output goes to ``stdout``
+    as in stream_csv_psql().
+    """
+    path = os.path.abspath(infile)
+    state = load_state(state_path)
+    record = state.get(path)
+    key = key and variablize(key)
+
+    f = file(infile, 'rb')
+    header = f.readline()
+    columns = map(variablize, header.split(','))
+    end = complete_size(f)
+    valid = (record and record['table'] == table and record['offset'] <= end
+             and record.get('key') == key
+             and record['hash'] == prefix_hash(f, header, record['offset']))
+    f.close()
+
+    start = time.time()
+    if not valid:
+        record = {'table': table, 'key': key, 'rows': 0,
+                  'offset': len(header)}
+        before, after = table_queries(table, columns, types)
+        if key:
+            # built with the table, so upserts never find duplicates later
+            after.append('create unique index %s_%s_key on %s (%s);'
+                         % (table, key, table, key))
+        rows, status = copy_range(db, infile, table, record['offset'], end,
+                                  delim, chunk_size, before, after, stdout)
+        if status and key:
+            raise PsqlError('loading %s into %s failed, check that %s is'
+                            ' unique' % (infile, table, key))
+    elif record['offset'] == end:
+        rows, status = 0, 0
+    else:
+        cols = ','.join(columns)
+        if key:
+            updates = ','.join('%s=excluded.%s' % (c, c)
+                               for c in columns if c != key)
+            before = [
+                'create temp table new_rows as select %s from %s with no data;'
+                % (cols, table),
+            ]
+            conflict = updates and 'do update set %s' % updates or 'do nothing'
+            after = [
+                'insert into %s (%s) select %s from new_rows'
+                ' on conflict (%s) %s;' % (table, cols, cols, key, conflict),
+            ]
+            rows, status = copy_range(db, infile, 'new_rows',
+                                      record['offset'], end, delim,
+                                      chunk_size, before, after, stdout)
+        else:
+            rows, status = copy_range(db, infile, '%s (%s)' % (table, cols),
+                                      record['offset'], end, delim,
+                                      chunk_size, stdout=stdout)
+    if status:
+        # keep the old state so the next run tries these rows again
+        raise PsqlError('loading %s into %s failed' % (infile, table))
+    if progress:
+        report_progress(rows, time.time() - start, end='\n')
+
+    f = file(infile, 'rb')
+    record['rows'] += rows
+    record['offset'] = end
+    record['hash'] = prefix_hash(f, header, end)
+    f.close()
+    state[path] = record
+    save_state(state, state_path)
+
+def complete_size(f):
+    """Byte offset just past the last newline, ignoring a partial last line."""
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    pos = size
+    while pos > 0:
+        start = max(0, pos - CHUNK_SIZE)
+        f.seek(start)
+        nl = f.read(pos - start).rfind('\n')
+        if nl != -1:
+            return start + nl + 1
+        pos = start
+    return 0
+
+def prefix_hash(f, header, offset):
+    f.seek(max(len(header), offset - HASH_BYTES))
+    data = f.read(offset - f.tell()) if offset > f.tell() else ''
+    return sha1(header + data).hexdigest()
+
+def load_state(state_path=STATE_PATH):
+    try:
+        with open(state_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save_state(state, state_path=STATE_PATH):
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.rename(state_path + '.tmp', state_path)
+
+def report_progress(rows, elapsed, end='\r'):
+    rate = rows / elapsed if elapsed else 0
+    sys.stderr.write('%d lines, %.0f lines/sec%s' % (rows, rate, end))
+    sys.stderr.flush()
+
+
+def record_ranges(infile, parts, chunk_size=CHUNK_SIZE):
+    """
+    Split the rows after the header into at most ``parts`` byte ranges that
+    begin and end on record boundaries. Newlines inside quotes are skipped
+    by tracking quote parity, so the file is read once but never parsed.
+    """
+    size = os.path.getsize(infile)
+    f = file(infile, 'rb')
+    start = len(f.readline())
+    targets = [start + (size - start) * i // parts for i in range(1, parts)]
+    bounds = [start]
+    in_quotes = False
+    pos = start
+    while targets:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        i = 0
+        while targets and targets[0] < pos + len(chunk):
+            target = max(targets[0] - pos, i)
+            in_quotes ^= bool(chunk.count('"', i, target) % 2)
+            i = target
+            while True:
+                nl = chunk.find('\n', i)
+                q = chunk.find('"', i)
+                if q != -1 and (nl == -1 or q < nl):
+                    in_quotes = not in_quotes
+                    i = q + 1
+                elif nl == -1:
+                    i = len(chunk) # boundary is in a later chunk
+                    break
+                else:
+                    i = nl + 1
+                    if not in_quotes:
+                        bounds.append(pos + i)
+                        targets = [t for t in targets if t > pos + i]
+                        break
+            if i == len(chunk):
+                break
+        in_quotes ^= bool(chunk.count('"', i) % 2)
+        pos += len(chunk)
+    f.close()
+
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if a < b]
+
+def read_range(infile, start, end):
+    """Yield the lines of ``infile`` from byte ``start`` up to ``end``."""
+    f = file(infile, 'rb')
+    f.seek(start)
+    while start < end:
+        line = f.readline()
+        if not line:
+            break
+        start += len(line)
+        yield line
+    f.close()
+
+def column_candidates(rows, num_columns):
+    """Narrow each column's possible types, as a list per column."""
+    candidates = [TYPES[:] for i in range(num_columns)]
+    for row in rows:
+        for col, value in enumerate(row[:num_columns]):
+            if value and candidates[col]:
+                candidates[col] = [t for t in candidates[col] if t[1](value)]
+    return [[t[0] for t in c] for c in candidates]
+
+def _range_candidates(args):
+    infile, start, end, delim, num_columns = args
+    rows = csv.reader(read_range(infile, start, end), delimiter=delim)
+    return column_candidates(rows, num_columns)
+
+def infer_types(infile, delim=',', sample=None, processes=1):
+    """
+    Guess a postgres type for every column, from the first ``sample`` rows
+    or, without a sample, the whole file split over ``processes`` workers.
+    Columns that are always empty or fit nothing stay DEFAULT_TYPE.
+    """
+    f = file(infile, 'rb')
+    num_columns = len(f.readline().split(','))
+    if sample:
+        rows = csv.reader(f, delimiter=delim)
+        results = [column_candidates(islice(rows, sample), num_columns)]
+    else:
+        tasks = [(infile, a, b, delim, num_columns)
+                 for a, b in record_ranges(infile, processes)]
+        if processes > 1:
+            from multiprocessing import Pool
+            pool = Pool(processes)
+            results = pool.map(_range_candidates, tasks)
+            pool.close()
+        else:
+            results = map(_range_candidates, tasks)
+    f.close()
+
+    types = []
+    for col in range(num_columns):
+        names = [t[0] for t in TYPES]
+        for r in results:
+            names = [n for n in names if n in r[col]]
+        seen = any(r[col] != [t[0] for t in TYPES] for r in results)
+        types.append(names[0] if names and seen else DEFAULT_TYPE)
+    return types
+
+
 def variablize(text, prefix=''):
     if not prefix:
         # if no prefix, move any digits or non-word chars to the end
@@ -38,6 +436,17 @@ if __name__ == '__main__':
     parser.add_option('-t', '--table', help='name of new table to create', default='newtable')
     parser.add_option('-d', '--tmpdir', help='path to temporary directory which psql has permission to access', default='/tmp')
     parser.add_option('-s', '--separator', help='field delimiter character', default=',')
+    parser.add_option('-S', '--stream', action='store_true', help='stream the file to psql over one connection instead of copying it to tmpdir')
+    parser.add_option('-c', '--chunk-size', type='int', help='bytes to read at a time when streaming', default=CHUNK_SIZE)
+    parser.add_option('-i', '--infer', action='store_true', help='scan the whole file to pick column types instead of varchar')
+    parser.add_option('-n', '--sample', type='int', help='pick column types from the first SAMPLE rows')
+    parser.add_option('-j', '--jobs', type='int', help='worker processes for --infer', default=1)
+    parser.add_option('-p', '--parallel', type='int', help='split the file and load it over this many connections at once')
+    parser.add_option('-u', '--staging', action='store_true', help='with --parallel, load into an unlogged staging table and swap it in at the end')
+    parser.add_option('-a', '--append', action='store_true', help='only load rows added since the last --append run of this file')
+    parser.add_option('-k', '--key', help='with --append, upsert on this column instead of inserting')
+    parser.add_option('--state', help='file recording what --append has loaded', default=STATE_PATH)
+    parser.add_option('-q', '--quiet', action='store_true', help='do not report progress when streaming')
     (options, args) = parser.parse_args()
 
     if not len(args) == 2:
@@ -50,5 +459,25 @@ if __name__ == '__main__':
     else:
         table = options.table
 
-    load_csv_psql(db, infile, table, options.tmpdir, option.separator)
+    types = None
+    if options.infer or options.sample:
+        types = infer_types(infile, options.separator, options.sample,
+                            options.jobs)
 
+    try:
+        if options.append or options.key:
+            incremental_csv_psql(db, infile, table, options.separator,
+                                 options.key, options.chunk_size,
+                                 not options.quiet, types, options.state)
+        elif options.parallel:
+            parallel_csv_psql(db, infile, table, options.separator,
+                              options.parallel, options.chunk_size,
+                              not options.quiet, types, options.staging)
+        elif options.stream:
+            stream_csv_psql(db, infile, table, options.separator,
+                            options.chunk_size, not options.quiet, types)
+        else:
+            load_csv_psql(db, infile, table, options.tmpdir,
+                          options.separator, types)
+    except PsqlError as e:
+        sys.exit(e.message)
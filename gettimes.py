@@ -1,57 +1,381 @@
 #!/usr/bin/env python
 
+import cPickle as pickle
+import csv
 import datetime
+import json
+import os
 import re
+import sys
+from array import array
+from fnmatch import fnmatchcase
+from itertools import izip
+from hashlib import sha1
+from collections import namedtuple
 from textwrap import TextWrapper
 
 filepath = 'times.txt'
 date_format = '%a %b %d %Y'
+CACHE_PATH = os.path.expanduser('~/.gettimes.cache')
+HASH_BYTES = 4096
 
-f = file(filepath, 'r')
-current_date = []
+DATE_LINE = re.compile(
+    r'^(Mon|Tue|Wed|Thu|Fri|Sat|Sun) '
+    r'(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) (\d{1,2})$')
+MONTHS = dict((m, i + 1) for i, m in enumerate(
+    'Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec'.split()))
+PROJECT_LINE = re.compile(
+    r'^(\d{1,2}:\d{2}\s?-\s?\d{1,2}:\d{2}\s?&?\s?)+@([a-zA-Z0-9\-_]+)$')
+INTERVAL = re.compile(r'(\d{1,2}):(\d{2})\s?-\s?(\d{1,2}):(\d{2})')
 
-times = {}
-# times[date][projects][project][tasks][task] = interval
-# times[date][projects][project][total] = interval
-# times[date][total] = interval
 
-def parse_line_as_date(line):
-    line = '%s %s' % (line, datetime.datetime.today().year)
+class Entry(namedtuple('Entry', 'date project intervals task')):
+    """
+    One block of a times file. ``intervals`` are (start, end) minutes after
+    midnight of ``date``; an end before its start hour runs past midnight.
+    """
+    __slots__ = ()
+
+    @property
+    def minutes(self):
+        return sum(end - start for start, end in self.intervals)
+
+    @property
+    def duration(self):
+        return datetime.timedelta(minutes=self.minutes)
+
+
+def parse_date(line, year):
+    """Same as strptime with date_format, without its per-call overhead."""
+    match = DATE_LINE.match(line)
+    if not match:
+        return None
     try:
-        current_date.append(datetime.datetime.strptime(line, date_format))
+        return datetime.datetime(year, MONTHS[match.group(2)],
+                                 int(match.group(3)))
     except ValueError:
-        return False
-    else:
-        return True
+        return None
 
-def matches_proj_time_fmt(line):
-    pattern = r'^(\d{1,2}:\d{2}\s?-\s?\d{1,2}:\d{2}\s?&?\s?)+(@[a-zA-Z0-9\-_]+)$'
-    if re.match(pattern, line):
-        return True
-    else:
-        return False
-
-def parse_line_as_project_time(line):
-    times, project = line.split('@')
-    interval = get_interval(times)
-    return (project, interval)
-
-def get_interval(timestr):
-    timestr = timestr.replace(' ','').strip()
-    parts = timestr.split('&')
-    total = datetime.timedelta()
-    dt = current_date[-1]
-    for intvlstr in parts:
-        fr, to = intvlstr.split('-')
-        fr_hour, fr_min = fr.split(':')
-        to_hour, to_min = to.split(':')
-        fr_date = dt.replace(hour=int(fr_hour), minute=int(fr_min))
-        to_date = dt.replace(hour=int(to_hour), minute=int(to_min))
-        if int(fr_hour) > int(to_hour):
-            to_date = to_date + datetime.timedelta(days=1)
-        intvl = to_date - fr_date
-        total += intvl
-    return total
+def parse_intervals(timestr):
+    intervals = []
+    for fr_hour, fr_min, to_hour, to_min in INTERVAL.findall(timestr):
+        fr_hour, to_hour = int(fr_hour), int(to_hour)
+        start = fr_hour * 60 + int(fr_min)
+        end = to_hour * 60 + int(to_min)
+        if fr_hour > to_hour:
+            end += 24 * 60
+        intervals.append((start, end))
+    return tuple(intervals)
+
+def parse(lines, year=None, date=None, tasks=True):
+    """
+    Yield an Entry for each project line in ``lines``, in one pass. Dates
+    are lines like "Wed Jan 11" and take ``year``, by default this one.
+    Project lines before the first date are skipped unless a starting
+    ``date`` is given. Without ``tasks`` task text is left empty.
+    """
+    year = year or datetime.datetime.today().year
+    entry = None
+    task = []
+    seen = {} # time ranges repeat a lot, parse each distinct one once
+    for line in lines:
+        if entry:
+            if line.startswith(' '):
+                if tasks:
+                    task.append(line.strip())
+                continue
+            yield Entry(entry[0], entry[1], entry[2], ' '.join(task))
+            entry = None
+
+        line = line.rstrip()
+        first = line[:1]
+        if first.isdigit():
+            match = PROJECT_LINE.match(line)
+            if match and date:
+                timestr = line[:match.start(2) - 1]
+                intervals = seen.get(timestr)
+                if intervals is None:
+                    intervals = seen[timestr] = parse_intervals(timestr)
+                entry = (date, match.group(2), intervals)
+                task = []
+        elif first.isupper():
+            date = parse_date(line, year) or date
+
+    if entry:
+        yield Entry(entry[0], entry[1], entry[2], ' '.join(task))
+
+def aggregate(entries, times=None):
+    """
+    Total entries into times[date]['projects'][project]['tasks'][task],
+    with a 'total' at the date and project levels.
+    """
+    times = {} if times is None else times
+    for e in entries:
+        intvl = e.duration
+        day = times.setdefault(
+            e.date, {'projects': {}, 'total': datetime.timedelta()})
+        proj = day['projects'].setdefault(
+            e.project, {'total': datetime.timedelta(), 'tasks': {}})
+        day['total'] += intvl
+        proj['total'] += intvl
+        proj['tasks'][e.task] = proj['tasks'].get(
+            e.task, datetime.timedelta()) + intvl
+    return times
+
+def compact(entries, days=None):
+    """
+    Total entries as {day ordinal: {project: {task: minutes}}}, which is
+    much cheaper to pickle between processes than the times dict.
+    """
+    days = {} if days is None else days
+    for e in entries:
+        tasks = days.setdefault(e.date.toordinal(), {}).setdefault(e.project, {})
+        tasks[e.task] = tasks.get(e.task, 0) + e.minutes
+    return days
+
+def merge(days, into):
+    """Add one compact() result into another."""
+    for o, projects in days.iteritems():
+        into_projects = into.setdefault(o, {})
+        for project, tasks in projects.iteritems():
+            into_tasks = into_projects.setdefault(project, {})
+            for task, minutes in tasks.iteritems():
+                into_tasks[task] = into_tasks.get(task, 0) + minutes
+    return into
+
+def expand(days, times=None):
+    """Merge a compact() result into a times dict like aggregate() makes."""
+    times = {} if times is None else times
+    td = datetime.timedelta
+    for o, projects in days.iteritems():
+        day = times.setdefault(datetime.datetime.fromordinal(o),
+                               {'projects': {}, 'total': td()})
+        for project, tasks in projects.iteritems():
+            proj = day['projects'].setdefault(project,
+                                              {'total': td(), 'tasks': {}})
+            for task, minutes in tasks.iteritems():
+                intvl = td(minutes=minutes)
+                day['total'] += intvl
+                proj['total'] += intvl
+                proj['tasks'][task] = proj['tasks'].get(task, td()) + intvl
+    return times
+
+def _compact_file(args):
+    path, year = args
+    with open(path) as f:
+        return compact(parse(f, year))
+
+def find_files(paths):
+    """Expand directories in ``paths`` to the non-hidden files under them."""
+    found = []
+    for path in paths:
+        if not os.path.isdir(path):
+            found.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            found.extend(os.path.join(root, f) for f in sorted(files)
+                         if not f.startswith('.'))
+    return found
+
+def compact_files(paths, year=None, processes=None):
+    """
+    Parse many times files over a process pool, each worker sending back a
+    compact() total of its file, and merge them.
+    """
+    from multiprocessing import Pool
+    pool = Pool(processes)
+    days = {}
+    for partial in pool.imap_unordered(_compact_file,
+                                       [(p, year) for p in paths]):
+        merge(partial, days)
+    pool.close()
+    pool.join()
+    return days
+
+def aggregate_files(paths, year=None, processes=None):
+    """Like compact_files(), returning a times dict for report()."""
+    return expand(compact_files(paths, year, processes))
+
+EXPORT_FIELDS = {
+    'day': ('date', 'minutes'),
+    'project': ('date', 'project', 'minutes'),
+    'task': ('date', 'project', 'task', 'minutes'),
+}
+
+def export_rows(days, level='task'):
+    """
+    Yield tuples of EXPORT_FIELDS[level] from a compact() total, sorted by
+    date, project and task.
+    """
+    for o in sorted(days):
+        date = datetime.date.fromordinal(o).isoformat()
+        projects = days[o]
+        if level == 'day':
+            yield (date, sum(sum(t.itervalues()) for t in projects.itervalues()))
+            continue
+        for project in sorted(projects):
+            tasks = projects[project]
+            if level == 'project':
+                yield (date, project, sum(tasks.itervalues()))
+                continue
+            for task in sorted(tasks):
+                yield (date, project, task, tasks[task])
+
+def write_csv(rows, fields, out):
+    w = csv.writer(out)
+    w.writerow(fields)
+    w.writerows(rows)
+
+def write_jsonl(rows, fields, out):
+    for row in rows:
+        out.write(json.dumps(dict(zip(fields, row)), sort_keys=True))
+        out.write('\n')
+
+def write_parquet(rows, fields, out):
+    import pyarrow
+    import pyarrow.parquet
+    columns = zip(*rows) or [()] * len(fields)
+    table = pyarrow.Table.from_arrays(
+        [pyarrow.array(c) for c in columns], names=list(fields))
+    pyarrow.parquet.write_table(table, out)
+
+EXPORTERS = {
+    'csv': write_csv,
+    'jsonl': write_jsonl,
+    'parquet': write_parquet,
+}
+
+class Columns(object):
+    """
+    Entries as parallel arrays of day ordinal, project id and minutes, for
+    totalling by range and group without the nested times dict.
+    """
+    def __init__(self, entries=()):
+        self.days = array('l')
+        self.project_ids = array('l')
+        self.minutes = array('l')
+        self.projects = []
+        self._ids = {}
+        self.extend(entries)
+
+    def extend(self, entries):
+        for e in entries:
+            pid = self._ids.get(e.project)
+            if pid is None:
+                pid = self._ids[e.project] = len(self.projects)
+                self.projects.append(e.project)
+            self.days.append(e.date.toordinal())
+            self.project_ids.append(pid)
+            self.minutes.append(e.minutes)
+
+    def __len__(self):
+        return len(self.days)
+
+GROUPS = {
+    'day': lambda o: datetime.date.fromordinal(o).isoformat(),
+    'week': lambda o: '%d-W%02d' % datetime.date.fromordinal(o).isocalendar()[:2],
+    'month': lambda o: datetime.date.fromordinal(o).strftime('%Y-%m'),
+}
+
+def query(columns, start=None, end=None, project=None, group_by=('project',)):
+    """
+    Total minutes per group for rows dated ``start`` to ``end`` inclusive
+    whose project matches the glob ``project``. ``group_by`` names any of
+    day, week, month and project. Returns a sorted list of (key, minutes)
+    where key is a tuple with one string per group.
+    """
+    lo = start.toordinal() if start else 0
+    hi = end.toordinal() if end else sys.maxint
+    wanted = [project is None or fnmatchcase(p, project)
+              for p in columns.projects]
+
+    # group keys only depend on the day or the project, so build each once
+    day_keys = {}
+    def day_key(o):
+        key = day_keys.get(o)
+        if key is None:
+            key = day_keys[o] = tuple(GROUPS[g](o) for g in group_by
+                                      if g != 'project')
+        return key
+    with_project = 'project' in group_by
+    at = with_project and group_by.index('project')
+
+    totals = {}
+    for o, pid, m in izip(columns.days, columns.project_ids, columns.minutes):
+        if o < lo or o > hi or not wanted[pid]:
+            continue
+        key = day_key(o)
+        if with_project:
+            key = key[:at] + (columns.projects[pid],) + key[at:]
+        totals[key] = totals.get(key, 0) + m
+    return sorted(totals.items())
+
+def cached_times(path, year=None, cache_path=CACHE_PATH):
+    """
+    Aggregate the times file at ``path``, re-parsing only what was appended
+    since the last call. The cache records the file's device and inode, how
+    far it has been aggregated, the date in effect there and a hash of the
+    bytes just before it; if any of those no longer match, the whole file
+    is parsed again.
+
+    Aggregation stops at the start of the last unindented line, because an
+    entry's task lines can still be added to. The rest is parsed every time
+    and merged in only after the cache is saved.
+    """
+    year = year or datetime.datetime.today().year
+    path = os.path.abspath(path)
+    cache = load_cache(cache_path)
+    st = os.stat(path)
+    f = open(path, 'rb')
+    record = cache.get((path, year))
+    if not (record and record['id'] == (st.st_dev, st.st_ino)
+            and record['offset'] <= st.st_size
+            and record['hash'] == tail_hash(f, record['offset'])):
+        record = {'id': (st.st_dev, st.st_ino), 'offset': 0, 'date': None,
+                  'times': {}}
+
+    f.seek(record['offset'])
+    lines = f.readlines()
+    cut = 0
+    for i, line in enumerate(lines):
+        if i and not line.startswith(' '):
+            cut = i
+
+    if cut:
+        done = lines[:cut]
+        aggregate(parse(done, year, record['date']), record['times'])
+        record['date'] = last_date(done, year) or record['date']
+        record['offset'] += sum(len(l) for l in done)
+        record['hash'] = tail_hash(f, record['offset'])
+        cache[(path, year)] = record
+        save_cache(cache, cache_path)
+    f.close()
+
+    return aggregate(parse(lines[cut:], year, record['date']),
+                     record['times'])
+
+def last_date(lines, year):
+    for line in reversed(lines):
+        date = parse_date(line.rstrip(), year)
+        if date:
+            return date
+
+def tail_hash(f, offset):
+    f.seek(max(0, offset - HASH_BYTES))
+    return sha1(f.read(offset - f.tell())).hexdigest()
+
+def load_cache(cache_path=CACHE_PATH):
+    try:
+        with open(cache_path, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return {}
+
+def save_cache(cache, cache_path=CACHE_PATH):
+    with open(cache_path + '.tmp', 'wb') as f:
+        pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(cache_path + '.tmp', cache_path)
 
 def fmtdur(dur, fmt='{:02d}:{:02d}'):
     h = dur.total_seconds() // 3600
@@ -59,60 +383,97 @@ def fmtdur(dur, fmt='{:02d}:{:02d}'):
     s = dur.total_seconds() % 60
     return fmt.format(int(h), int(m), int(s))
 
+def report(times, out=sys.stdout):
+    grand_total = datetime.timedelta()
+    #wrapper = TextWrapper(width=65, subsequent_indent=" "*13)
+    wrapper = TextWrapper(width=255, subsequent_indent=" "*0)
 
-l = f.next()
-while 1:
-    l = l.rstrip()
-    if l.startswith('-'):
-        try:
-            l = f.next()
-        except StopIteration:
-            break
-    elif parse_line_as_date(l):
-        times[current_date[-1]] = {'projects': {}, 'total': datetime.timedelta()}
-        l = f.next()
-    elif matches_proj_time_fmt(l):
-        proj_intvl = parse_line_as_project_time(l)
-        if proj_intvl:
-            dt = current_date[-1]
-            project, intvl = proj_intvl
-            times[dt]['projects'].setdefault(project, {'total': datetime.timedelta(), 'tasks': {}})
-            times[dt]['total'] += intvl
-            times[dt]['projects'][project]['total'] += intvl
-            task = ''
-            l = f.next()
-            while l and l.startswith(' '):
-                task = '%s %s' % (task, l.strip())
-                try:
-                    l = f.next()
-                except StopIteration:
-                    l = False
-            times[dt]['projects'][project]['tasks'].setdefault(task, datetime.timedelta())
-            times[dt]['projects'][project]['tasks'][task] += intvl
-            if not l:
-                break
-    else:
-        try:
-            l = f.next()
-        except StopIteration:
-            break
+    for dt in sorted(times):
+        dtd = times[dt]
+        grand_total += dtd['total']
+        out.write('-'*18 + '\n')
+        out.write('%s on %s\n' % (fmtdur(dtd['total']), dt.strftime("%a %b %d")))
+        for p, pd in dtd['projects'].items():
+            out.write('  %s @%s\n' % (fmtdur(pd['total']), p))
+            for task, intvl in pd['tasks'].items():
+                out.write('    [%s]  %s\n' % (fmtdur(intvl), wrapper.fill(task)))
 
-dates = times.keys()
-dates.sort()
-grand_total = datetime.timedelta()
+    out.write('-'*18 + '\n')
+    out.write('Total {}\n'.format(fmtdur(grand_total)))
 
-for dt in dates:
-    #wrapper = TextWrapper(width=65, subsequent_indent=" "*13)
-    wrapper = TextWrapper(width=255, subsequent_indent=" "*0)
-    dtd = times[dt]
-    grand_total += dtd['total']
-    print '-'*18
-    print '%s on %s' % (fmtdur(dtd['total']), dt.strftime("%a %b %d"))
-    for p, pd in dtd['projects'].items():
-        print '  %s @%s' % (fmtdur(pd['total']), p)
-        for task, intvl in pd['tasks'].items():
-            print '    [%s] %s' % (fmtdur(intvl), wrapper.fill(task))
-
-print '-'*18
-print 'Total {}'.format(fmtdur(grand_total))
 
+if __name__ == '__main__':
+    from optparse import OptionParser
+    usage = "Usage: %prog [options] [times_file_or_dir ...]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-y', '--year', type='int',
+                      help="Year of the dates in the file, default this year")
+    parser.add_option('-n', '--no-cache', action='store_true',
+                      help="Parse the whole file instead of using the cache")
+    parser.add_option('-j', '--jobs', type='int',
+                      help="Worker processes when reading several files,"
+                           " defaults to CPU count")
+    parser.add_option('-e', '--export', choices=sorted(EXPORTERS),
+                      help="Write totals as csv, jsonl or parquet (needs"
+                           " pyarrow) instead of the text report")
+    parser.add_option('-l', '--level', choices=sorted(EXPORT_FIELDS),
+                      default='task',
+                      help="Export totals per day, project or task (default)")
+    parser.add_option('-o', '--output', help="Export to this file, not stdout")
+    parser.add_option('-g', '--group-by',
+                      help="Comma separated totals by day, week, month"
+                           " and/or project instead of the full report")
+    parser.add_option('-p', '--project', help="Only projects matching this glob")
+    parser.add_option('-f', '--from', dest='start', metavar='YYYY-MM-DD',
+                      help="Only dates from this one on")
+    parser.add_option('-t', '--to', dest='end', metavar='YYYY-MM-DD',
+                      help="Only dates up to and including this one")
+    options, args = parser.parse_args()
+
+    path = args[0] if args else filepath
+    if len(args) > 1 or os.path.isdir(path):
+        paths = find_files(args)
+    else:
+        paths = None
+
+    if options.export:
+        if options.export == 'parquet' and not options.output:
+            parser.error("parquet export needs --output")
+        if paths:
+            days = compact_files(paths, options.year, options.jobs)
+        else:
+            f = sys.stdin if path == '-' else open(path)
+            days = compact(parse(f, options.year, tasks=options.level == 'task'))
+        if options.output:
+            out = open(options.output, 'wb', 1 << 16)
+        else:
+            out = os.fdopen(sys.stdout.fileno(), 'wb', 1 << 16)
+        EXPORTERS[options.export](export_rows(days, options.level),
+                                  EXPORT_FIELDS[options.level], out)
+        out.close()
+    elif options.group_by or options.project or options.start or options.end:
+        group_by = tuple((options.group_by or 'project').split(','))
+        for g in group_by:
+            if g != 'project' and g not in GROUPS:
+                parser.error("can't group by {}".format(g))
+        start, end = [d and datetime.datetime.strptime(d, '%Y-%m-%d')
+                      for d in (options.start, options.end)]
+        columns = Columns()
+        for p in paths or [path]:
+            f = sys.stdin if p == '-' else open(p)
+            columns.extend(parse(f, options.year, tasks=False))
+        total = 0
+        for key, minutes in query(columns, start, end, options.project,
+                                  group_by):
+            total += minutes
+            print('{}  {}'.format(fmtdur(datetime.timedelta(minutes=minutes)),
+                                  '  '.join(key)))
+        print('Total {}'.format(fmtdur(datetime.timedelta(minutes=total))))
+    elif paths:
+        report(aggregate_files(paths, options.year, options.jobs))
+    elif path == '-':
+        report(aggregate(parse(sys.stdin, options.year)))
+    elif options.no_cache:
+        report(aggregate(parse(open(path), options.year)))
+    else:
+        report(cached_times(path, options.year))
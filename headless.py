@@ -0,0 +1,27 @@
+"""
+Stand-ins for the iTerm objects the cycle scripts use through appscript,
+so they run without iTerm, such as on Linux.
+"""
+
+
+class HeadlessProperty(object):
+    """Stands in for an appscript property, stored in a text file."""
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self):
+        try:
+            with open(self.path) as f:
+                return [f.read()]
+        except IOError:
+            return [u'']
+
+    def set(self, value):
+        with open(self.path, 'w') as f:
+            f.write(value)
+
+
+class HeadlessSession(object):
+    """Stands in for an iTerm session."""
+    def __init__(self, state_file):
+        self.background_image_path = HeadlessProperty(state_file)
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
-from appscript import app, its
+import bgdaemon
 import splitscreenbgs as ss
+from bgpool import POOL_SIZE, render_bg
+from headless import HeadlessSession
 
 SCREEN_WIDTH = 1600
 SCREEN_HEIGHT = 876 # 900 - tab height
@@ -16,15 +18,24 @@ class ItermSessionBG:
     session = None
     current = None
     threshhold = None
+    pool_size = POOL_SIZE
+    use_daemon = True
 
-    def __init__(self, tty, prefix=None):
+    def __init__(self, tty, prefix=None, session=None, num=None,
+                 input_dir=INPUT_DIR, output_dir=OUTPUT_DIR):
         self.tty = tty
-        self.num = tty[-2:]
+        self.num = num or tty[-2:]
         self.prefix = prefix
+        self.input_dir = input_dir
+        self.output_dir = output_dir
 
-        iterm = app('iTerm')
-        term = iterm.current_terminal()
-        self.session = term.sessions[its.id==tty]
+        if session:
+            self.session = session
+        else:
+            from appscript import app, its
+            iterm = app('iTerm')
+            term = iterm.current_terminal()
+            self.session = term.sessions[its.id==tty]
         self.current = self.session.background_image_path()[0]
 
         if not self.current or self.current.__repr__() == 'k.missingvalue':
@@ -40,7 +51,7 @@ class ItermSessionBG:
         return '{}.{}'.format(self.prefix, self.num)
 
     def filepath(self):
-        return '{}/{}.jpg'.format(OUTPUT_DIR, self.filename())
+        return '{}/{}.jpg'.format(self.output_dir, self.filename())
 
     def set_session_bg(self, path=None):
         if not path:
@@ -52,25 +63,21 @@ class ItermSessionBG:
         self.session.background_image_path.set(u'')
 
     def change_session_bg(self, filename=None):
-        size = ss.get_size_from_image(self.prefix, OUTPUT_DIR)
-        pattern = filename and '{{}}/{}'.format(filename) or None
-        path = ss.choose_pic(INPUT_DIR, size[0], size[1], pattern=pattern)
-        if not path:
-            raise Exception("\tNo images in {} match parameters".format(INPUT_DIR))
-
-        try:
-            im = ss.make_bg(path, size, self.threshhold)
-        except ss.GenerateImageError as e:
-            print("\tError generating image: {}".format(e.message))
+        args = (self.input_dir, self.output_dir, self.prefix, self.filepath(),
+                self.threshhold, self.pool_size, filename)
+        reply = self.use_daemon and bgdaemon.call('change', args=args)
+        if reply:
+            if 'error' in reply:
+                print(reply['error'])
+                return
+            source = reply['source']
         else:
             try:
-                im.save(self.filepath())
-            except Exception as e:
-                print("\tError saving image to {}: {}".format(self.filepath(),
-                                                              e.message))
-            else:
-                return (self.set_session_bg(self.filepath()), path)
-
+                source = render_bg(*args)
+            except ss.GenerateImageError as e:
+                print(e.message)
+                return
+        return (self.set_session_bg(self.filepath()), source)
 
 
 if __name__ == '__main__':
@@ -86,35 +93,75 @@ if __name__ == '__main__':
                       help="Width or height beyond which image should be resized"
                            " instead of cropped")
     parser.add_option('-u', '--unset', action='store_true')
+    parser.add_option('-n', '--pool', type='int', default=POOL_SIZE,
+                      help="Number of pre-rendered backgrounds to keep per"
+                           " prefix, 0 to always render on demand")
+    parser.add_option('--no-daemon', action='store_true',
+                      help="Render in this process even if bgdaemon.py is"
+                           " running")
+    parser.add_option('-i', '--input-dir', default=INPUT_DIR,
+                      help="Pictures to make backgrounds from, default"
+                           " %default")
+    parser.add_option('-o', '--output-dir', default=OUTPUT_DIR,
+                      help="Backgrounds and their pools, default %default")
+    parser.add_option('--headless', metavar='STATE_FILE',
+                      help="Keep the background path in STATE_FILE instead"
+                           " of talking to iTerm")
+    parser.add_option('--session', default='01',
+                      help="With --headless, the session number used in"
+                           " background names, default %default")
     parser.add_option('-l', '--list', action='store_true',
                       help='List current prefixes in out_dir')
     options, args = parser.parse_args()
 
     if options.list:
-        ss.list_sizes(OUTPUT_DIR)
+        out_dir = os.path.abspath(options.output_dir)
+        reply = not options.no_daemon and bgdaemon.call('list',
+                                                        out_dir=out_dir)
+        if reply:
+            print('\n'.join(reply['lines']))
+        else:
+            ss.list_sizes(out_dir)
         exit()
 
-    fd = sys.stdout.fileno()
-    tty = os.ttyname(fd)
+    num = None
+    if options.headless:
+        tty = options.headless
+        num = options.session
+        session = HeadlessSession(options.headless)
+    else:
+        fd = sys.stdout.fileno()
+        tty = os.ttyname(fd)
+        session = None
     if not tty:
         print('Error getting tty')
         exit()
 
-    bg = ItermSessionBG(tty, options.prefix)
+    # absolute, the daemon doesn't share our working directory
+    bg = ItermSessionBG(tty, options.prefix, session, num,
+                        os.path.abspath(options.input_dir),
+                        os.path.abspath(options.output_dir))
     if options.reload:
         exit() # initialization sets to last bg for prefix
 
     bg.threshhold = options.threshhold
+    bg.pool_size = options.pool
+    bg.use_daemon = not options.no_daemon
     if options.unset:
         bg.unset_bg()
     else:
         try:
             paths = bg.change_session_bg(filename=options.filename)
-            print("Changed {}\nto {}".format(*paths))
         except Exception as e:
             print e.message
         else:
+            if not paths:
+                exit(1) # the error was printed
+            print("Changed {}\nto {}".format(*paths))
+            if options.headless:
+                exit()
             # refresh screen by resizing text
+            from appscript import app
             iterm = app('System Events').processes['iTerm']
             menu = iterm.menu_bars[0].menus['View'].menu_items
             menu['Make Text Smaller'].click()
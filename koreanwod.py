@@ -1,31 +1,242 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import feedparser
-from pyquery import PyQuery
+import datetime
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import sys
+import time
+from subprocess import Popen
 
 url = "http://www.korean-flashcards.com/rss-feed-word.php?level={0:d}"
+LEVELS = (1, 2, 3)
+CACHE_DIR = os.path.expanduser('~/.koreanwod')
+CACHE_TTL = 6 * 60 * 60
+ARCHIVE_PATH = os.path.expanduser('~/.koreanwod.db')
+TIMEOUT = 10
 
-def get_words(level=1):
-    feed = feedparser.parse(url.format(level))
-    out = []
+def _cache_paths(feed_url, cache_dir):
+    name = hashlib.sha1(feed_url).hexdigest()
+    base = os.path.join(cache_dir, name)
+    return base + '.xml', base + '.json'
+
+def read_cache(feed_url, cache_dir=CACHE_DIR):
+    """The cached body and its metadata for a url, or (None, {})."""
+    body_path, meta_path = _cache_paths(feed_url, cache_dir)
+    try:
+        with open(body_path, 'rb') as f:
+            body = f.read()
+        with open(meta_path) as f:
+            return body, json.load(f)
+    except (IOError, ValueError):
+        return None, {}
+
+def write_cache(feed_url, body, meta, cache_dir=CACHE_DIR):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    for path, data in zip(_cache_paths(feed_url, cache_dir),
+                          (body, json.dumps(meta))):
+        tmp = '{}.{}'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+def is_fresh(meta, ttl=CACHE_TTL):
+    return time.time() - meta.get('fetched', 0) < ttl
+
+def fetch(feed_url, cache_dir=CACHE_DIR, ttl=CACHE_TTL, offline=False,
+          timeout=TIMEOUT):
+    """
+    The body of ``feed_url``, from the cache while it is younger than
+    ``ttl`` seconds, otherwise revalidated with the server's ETag and
+    Last-Modified. The cached copy is used when ``offline`` or when the
+    server can't be reached; with no cached copy either, the error is
+    raised.
+    """
+    body, meta = read_cache(feed_url, cache_dir)
+    if body is not None and (offline or is_fresh(meta, ttl)):
+        return body
+    if offline:
+        raise IOError("{} is not cached".format(feed_url))
+
+    import urllib2
 
-    for e in feed.entries:
-        pq = PyQuery(e.description)
+    request = urllib2.Request(feed_url)
+    if body is not None:
+        if meta.get('etag'):
+            request.add_header('If-None-Match', meta['etag'])
+        if meta.get('modified'):
+            request.add_header('If-Modified-Since', meta['modified'])
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+        new_body = response.read()
+        meta = {
+            'etag': response.info().getheader('ETag'),
+            'modified': response.info().getheader('Last-Modified'),
+        }
+    except urllib2.HTTPError as e:
+        if body is None:
+            raise
+        if e.code != 304:
+            return body
+        new_body = body # not modified, keep the validators we sent
+    except (urllib2.URLError, socket.error):
+        if body is None:
+            raise
+        return body
+
+    meta['fetched'] = time.time()
+    write_cache(feed_url, new_body, meta, cache_dir)
+    return new_body
+
+def fetch_levels(levels=LEVELS, feed_url=url, processes=None, **kwargs):
+    """
+    fetch() the feed for each of ``levels`` at once on a thread pool.
+    Returns {level: body}; levels that failed with nothing cached are left
+    out.
+    """
+    def one(level):
         try:
-            kor, pron, trans = pq.find('font')
-        except ValueError:
-            kor, pron, formality, trans = pq.find('font')
-        link = pq.find('a')[0]
-        out.append((
-            PyQuery(kor).text(),
-            PyQuery(pron).text(),
-            PyQuery(trans).text(),
-            link.attrib['href'],
-        ))
+            return level, fetch(feed_url.format(level), **kwargs)
+        except IOError: # URLError and socket.error included
+            return level, None
+
+    if kwargs.get('offline') or len(levels) < 2:
+        results = map(one, levels) # nothing to wait on in parallel
+    else:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(processes or len(levels))
+        try:
+            results = pool.map(one, levels)
+        finally:
+            pool.close()
+    return dict((level, body) for level, body in results if body is not None)
+
+def stale_levels(levels=LEVELS, feed_url=url, cache_dir=CACHE_DIR,
+                 ttl=CACHE_TTL):
+    return [level for level in levels
+            if not is_fresh(read_cache(feed_url.format(level), cache_dir)[1],
+                            ttl)]
 
+def refresh_async(levels=LEVELS, feed_url=url):
+    """Start a detached process to revalidate the cached feeds."""
+    script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    args = [sys.executable, script, '--refresh', '--feed-url', feed_url]
+    for level in levels:
+        args += ['-l', str(level)]
+    devnull = open(os.devnull, 'w')
+    Popen(args, stdout=devnull, stderr=devnull, close_fds=True,
+          preexec_fn=os.setsid)
+
+def parse_description(description):
+    """
+    (hangeul, pronunciation, translation, url) from an entry's HTML, which
+    is parsed once and walked once. Some entries have a formality note
+    between the pronunciation and translation.
+    """
+    from pyquery import PyQuery
+    fonts = []
+    href = None
+    for el in PyQuery(description).find('font, a'):
+        if el.tag == 'a':
+            if href is None:
+                href = el.attrib['href']
+        else:
+            fonts.append(' '.join(''.join(el.itertext()).split()))
+    if len(fonts) not in (3, 4) or href is None:
+        raise ValueError("Unexpected description {!r}".format(description))
+    return fonts[0], fonts[1], fonts[-1], href
+
+def parse_words(body):
+    import feedparser
+    return [parse_description(e.description)
+            for e in feedparser.parse(body).entries]
+
+def dated_words(body):
+    """parse_words() paired with each entry's publication date, or today."""
+    import feedparser
+    today = datetime.date.today().isoformat()
+    out = []
+    for e in feedparser.parse(body).entries:
+        published = e.get('published_parsed')
+        date = time.strftime('%Y-%m-%d', published) if published else today
+        out.append((date, parse_description(e.description)))
     return out
 
+class WordArchive(object):
+    """
+    Every word seen in a feed, stored in sqlite with the date it was
+    published and its level, so old words can be reviewed and searched
+    without the network.
+    """
+    def __init__(self, path=ARCHIVE_PATH):
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            create table if not exists words (
+                url text primary key,
+                hangeul text,
+                pronunciation text,
+                translation text,
+                level integer,
+                date text
+            );
+            create index if not exists words_date on words (date);
+            create index if not exists words_level on words (level, date);
+            create index if not exists words_hangeul on words (hangeul);
+        """)
+
+    def add(self, level, dated):
+        """Archive ``dated_words()`` of a level's feed, keeping first sightings."""
+        self.db.executemany(
+            'insert or ignore into words values (?, ?, ?, ?, ?, ?)',
+            [(w[3], w[0], w[1], w[2], level, date) for date, w in dated])
+        self.db.commit()
+
+    def _select(self, where, params, levels=None, tail=' order by date desc'):
+        sql = 'select hangeul, pronunciation, translation, url from words' \
+              ' where ' + where
+        if levels:
+            sql += ' and level in ({})'.format(','.join('?' * len(levels)))
+            params = tuple(params) + tuple(levels)
+        return self.db.execute(sql + tail, params).fetchall()
+
+    def random(self, count, levels=None):
+        return self._select('1', (), levels,
+                            ' order by random() limit {:d}'.format(count))
+
+    def between(self, start, end, levels=None):
+        """Words published from ``start`` to ``end`` inclusive, newest first."""
+        return self._select('date between ? and ?',
+                            (start.isoformat(), end.isoformat()), levels)
+
+    def last_month(self, levels=None, today=None):
+        first = (today or datetime.date.today()).replace(day=1)
+        end = first - datetime.timedelta(days=1)
+        return self.between(end.replace(day=1), end, levels)
+
+    def search(self, text, levels=None):
+        """Words whose hangeul, pronunciation or translation contain ``text``."""
+        return self._select(
+            'instr(hangeul, ?) or instr(pronunciation, ?)'
+            ' or instr(lower(translation), lower(?))', (text,) * 3, levels)
+
+def show(words, options):
+    for w in words:
+        if options.korean:
+            print(w[0].encode('utf-8'))
+        if options.pronunciation:
+            print(w[1])
+        if options.translation:
+            print(w[2])
+        if options.url:
+            print(w[3])
+
+def get_words(level=1, feed_url=url, **kwargs):
+    return parse_words(fetch(feed_url.format(level), **kwargs))
+
 
 if __name__ == '__main__':
     from optparse import OptionParser
@@ -42,28 +253,68 @@ if __name__ == '__main__':
                       help="Show translation")
     parser.add_option('-u', '--url', action='store_true',
                       help="Show url to word on korean-flashcards.com")
-    parser.add_option('-l', '--level', type='int', default=1,
+    parser.add_option('-l', '--level', type='int', action='append',
                       help="Number representing level 1, 2, or 3."
-                           " Basic, the default, is 1.")
+                           " Basic, the default, is 1. May be repeated.")
+    parser.add_option('-c', '--cached', action='store_true',
+                      help="Never wait on the network: show cached words and"
+                           " refresh stale feeds in the background")
+    parser.add_option('-o', '--offline', action='store_true',
+                      help="Only show cached words")
+    parser.add_option('--ttl', type='int', default=CACHE_TTL,
+                      help="Seconds before a cached feed is revalidated,"
+                           " default %default")
+    parser.add_option('--refresh', action='store_true',
+                      help="Revalidate the cached feeds and exit")
+    parser.add_option('--feed-url', default=url,
+                      help="Feed url template, {0} is the level")
+    parser.add_option('-r', '--review', type='int', metavar='NUMBER',
+                      help="Show this many random archived words")
+    parser.add_option('-m', '--last-month', action='store_true',
+                      help="Show archived words published last month")
+    parser.add_option('-s', '--search', metavar='TEXT',
+                      help="Show archived words containing TEXT")
+    parser.add_option('--archive', default=ARCHIVE_PATH,
+                      help="Word archive, default %default")
 
     (options, args) = parser.parse_args()
+    levels = options.level or [1]
+    archive = WordArchive(options.archive)
+
+    if options.refresh:
+        bodies = fetch_levels(levels, options.feed_url, ttl=0)
+        for level, body in bodies.items():
+            archive.add(level, dated_words(body))
+        sys.exit()
 
     if not (options.korean or options.pronunciation
             or options.translation or options.url):
         parser.error("You must specify at least one of -k, -p, -t, or -u."
                      " See --help for more info.")
 
-    number = 3 if len(args) == 0 else int(args[0])
+    if options.review or options.last_month or options.search:
+        if options.review:
+            show(archive.random(options.review, options.level), options)
+        if options.last_month:
+            show(archive.last_month(options.level), options)
+        if options.search:
+            text = options.search.decode('utf-8')
+            show(archive.search(text, options.level), options)
+        sys.exit()
 
-    words = get_words(options.level)
+    number = 3 if len(args) == 0 else int(args[0])
 
-    for w in words[:number]:
-        if options.korean:
-            print(w[0].encode('utf-8'))
-        if options.pronunciation:
-            print(w[1])
-        if options.translation:
-            print(w[2])
-        if options.url:
-            print(w[3])
+    if options.cached:
+        stale = stale_levels(levels, options.feed_url, ttl=options.ttl)
+        if stale:
+            refresh_async(stale, options.feed_url)
+    bodies = fetch_levels(levels, options.feed_url, ttl=options.ttl,
+                          offline=options.offline or options.cached)
 
+    for level in levels:
+        if level not in bodies:
+            sys.stderr.write("No words for level {}\n".format(level))
+            continue
+        dated = dated_words(bodies[level])
+        archive.add(level, dated)
+        show([w for date, w in dated[:number]], options)
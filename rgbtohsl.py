@@ -1,5 +1,11 @@
 #!/usr/bin/env python
 
+import sys
+from optparse import OptionParser
+
+CHUNK = 1 << 16 # pixels per batch, keeps the temporaries in cache
+_luts = None
+
 
 def rgbtohsl(hexcode='ffffff'):
     """
@@ -8,30 +14,212 @@ def rgbtohsl(hexcode='ffffff'):
     if hexcode[0] == '#':
         hexcode = hexcode[1:]
     r,g,b = (
-        int(hexcode[0:2], 16) / 255.0,
-        int(hexcode[2:4], 16) / 255.0,
-        int(hexcode[4:6], 16) / 255.0,
+        int(hexcode[0:2], 16),
+        int(hexcode[2:4], 16),
+        int(hexcode[4:6], 16),
     )
     maxval = max([r, g, b])
     minval = min([r, g, b])
-    h = s = l = (maxval + minval) / 2.0
+    total = maxval + minval
+    # each value is scaled before its one division, so one that is exactly
+    # halfway stays exact and rounds like rgbtohsl_array()'s
+    l = 100.0 * total / 510
 
     if maxval == minval:
         h = s = 0.0 # achromatic
     else:
         d = maxval - minval
-        s = d / (2.0 - (maxval + minval)) if l > 0.5 else d / (maxval + minval)
-        h = {
-            r: (g - b) / d + (6.0 if g < b else 0.0),
-            g: (b - r) / d + 2.0,
-            b: (r - g) / d + 4.0,
-        }[maxval]
-        h = h / 6.0
+        s = 100.0 * d / (510 - total if total > 255 else total)
+        # checked in order, so ties between channels pick a branch the
+        # same way every time
+        if maxval == r:
+            h = 60.0 * (g - b) / d + (360 if g < b else 0)
+        elif maxval == g:
+            h = 60.0 * (b - r) / d + 120
+        else:
+            h = 60.0 * (r - g) / d + 240
+
+    return [int(round(h)) % 360, int(round(s)), int(round(l))]
+
+def hsltorgb(h, s, l):
+    """
+    Degrees and percentages, as rgbtohsl returns them, to 0-255 channels.
+    """
+    h, s, l = (h % 360) / 360.0, s / 100.0, l / 100.0
+    if s == 0:
+        return [int(round(255*l))] * 3 # achromatic
+
+    q = l * (1 + s) if l < 0.5 else l + s - l * s
+    p = 2 * l - q
+
+    def channel(t):
+        t %= 1.0
+        if t < 1/6.0:
+            return p + (q - p) * 6 * t
+        if t < 1/2.0:
+            return q
+        if t < 2/3.0:
+            return p + (q - p) * (2/3.0 - t) * 6
+        return p
+
+    return [int(round(255*channel(t))) for t in (h + 1/3.0, h, h - 1/3.0)]
+
+def hex_array(hexcodes):
+    """An (n, 3) uint8 array from an iterable of 'rrggbb' or '#rrggbb'."""
+    import numpy as np
+    packed = np.fromiter((int(c.strip().lstrip('#'), 16) for c in hexcodes),
+                         np.uint32)
+    return np.column_stack((packed >> 16, packed >> 8 & 255,
+                            packed & 255)).astype(np.uint8)
+
+def _hue(r, g, b):
+    # the rgbtohsl() hue branches, over whole integer arrays
+    import numpy as np
+    maxval = np.maximum(np.maximum(r, g), b)
+    d = np.maximum(maxval - np.minimum(np.minimum(r, g), b), 1)
+    d = d.astype(np.float64)
+    h = np.where(maxval == r, 60 * (g - b) / d,
+                 np.where(maxval == g, 60 * (b - r) / d + 120,
+                          60 * (r - g) / d + 240))
+    h[h < 0] += 360
+    return h.astype(np.float32)
+
+def _tables():
+    """
+    Hue only depends on r - g and g - b, and saturation and lightness on
+    the largest and smallest channel, so each is a lookup into a table
+    built once: 511x511 for hue and 256x256 for the others.
+    """
+    import numpy as np
+    global _luts
+    if _luts is None:
+        rg, gb = np.mgrid[-255:256, -255:256]
+        b = -np.minimum(np.minimum(0, gb), rg + gb)
+        hue = _hue(b + gb + rg, b + gb, b).ravel()
+        maxval, minval = np.mgrid[0:256, 0:256]
+        total = (maxval + minval).astype(np.float32)
+        sat = (maxval - minval) * np.float32(100) \
+              / np.maximum(255 - np.abs(total - 255), 1)
+        light = total * np.float32(100) / np.float32(510)
+        _luts = hue, sat.ravel(), light.ravel()
+    return _luts
 
-    return [int(360*h), int(100*s), int(100*l)]
+def _rgbtohsl_chunk(rgb, out):
+    import numpy as np
+    hue, sat, light = _tables()
+    r, g, b = np.ascontiguousarray(rgb.T, np.uint8)
+    i = np.maximum(np.maximum(r, g), b).astype(np.intp)
+    i <<= 8
+    i |= np.minimum(np.minimum(r, g), b)
+    out[:, 1] = sat.take(i)
+    out[:, 2] = light.take(i)
+    i = r.astype(np.intp)
+    i -= g
+    i *= 511
+    i += g
+    i -= b
+    i += 255 * 512
+    out[:, 0] = hue.take(i)
+
+def rgbtohsl_array(rgb, chunk=CHUNK):
+    """
+    Vectorized rgbtohsl() over an array of 0-255 channels shaped (..., 3),
+    such as an image. Returns float32 degrees and percentages in the same
+    shape, unrounded.
+    """
+    import numpy as np
+    rgb = np.asarray(rgb)
+    flat = rgb.reshape(-1, 3)
+    out = np.empty(flat.shape, np.float32)
+    for i in xrange(0, len(flat), chunk):
+        _rgbtohsl_chunk(flat[i:i + chunk], out[i:i + chunk])
+    return out.reshape(rgb.shape)
+
+def _hsltorgb_chunk(hsl, out):
+    # channel = l - a * clip(3 - |k - 6|, -1, 1) with k = (n + h / 30) % 12,
+    # the same curve as hsltorgb() in a form that needs no branches
+    import numpy as np
+    # a copy even when hsl is already float32, it is changed in place below
+    h, s, l = np.array(hsl.T, np.float32, order='C')
+    if len(h) and (h.min() < 0 or h.max() >= 360):
+        np.mod(h, 360, out=h)
+    h *= np.float32(1 / 30.0)
+    l *= np.float32(2.55)
+    a = l - np.float32(127.5)
+    np.abs(a, out=a)
+    np.subtract(127.5, a, out=a)
+    a *= s
+    a *= np.float32(0.01)
+    k = np.empty_like(h)
+    for i, n in enumerate((0, 8, 4)):
+        np.add(h, n, out=k)
+        np.subtract(k, 12, out=k, where=k >= 12)
+        k -= 6
+        np.abs(k, out=k)
+        np.subtract(3, k, out=k)
+        np.clip(k, -1, 1, out=k)
+        k *= a
+        np.subtract(l, k, out=k)
+        k += 0.5
+        np.clip(k, 0, 255, out=k)
+        out[:, i] = k
+
+def hsltorgb_array(hsl, chunk=CHUNK):
+    """
+    Vectorized hsltorgb() over an array of degrees and percentages shaped
+    (..., 3). Returns uint8 channels in the same shape.
+    """
+    import numpy as np
+    hsl = np.asarray(hsl)
+    flat = hsl.reshape(-1, 3)
+    out = np.empty(flat.shape, np.uint8)
+    for i in xrange(0, len(flat), chunk):
+        _hsltorgb_chunk(flat[i:i + chunk], out[i:i + chunk])
+    return out.reshape(hsl.shape)
+
+def image_hsl(path):
+    """The HSL of every pixel of an image, shaped (height, width, 3)."""
+    import numpy as np
+    from PIL import Image
+    return rgbtohsl_array(np.asarray(Image.open(path).convert('RGB')))
+
+def convert_stream(infile, outfile, reverse=False):
+    """
+    Convert one color per line: hex codes to 'hex: h s l', or with
+    ``reverse`` 'h s l' triples (spaces or commas) to 'h s l: rrggbb'.
+    """
+    import numpy as np
+    lines = [line.strip() for line in infile if line.strip()]
+    if reverse:
+        hsl = np.array([line.replace(',', ' ').split() for line in lines],
+                       np.float32).reshape(-1, 3)
+        for line, (r, g, b) in zip(lines, hsltorgb_array(hsl).tolist()):
+            outfile.write('{}: {:02x}{:02x}{:02x}\n'.format(line, r, g, b))
+    else:
+        # halves round up as round() does in rgbtohsl(), not to even
+        hsl = np.floor(rgbtohsl_array(hex_array(lines)) + 0.5).astype(int)
+        hsl[:, 0] %= 360
+        for line, (h, s, l) in zip(lines, hsl.tolist()):
+            outfile.write('{}: {:>3} {:>3} {:>3}\n'.format(line, h, s, l))
 
 if __name__ == '__main__':
-    import sys
-    color = sys.argv[1]
-    h,s,l = rgbtohsl(color)
-    print('{}: {:>3} {:>3} {:>3}'.format(color, h, s, l))
+    usage = "Usage: %prog hexcode\n" \
+            "       %prog -r h s l\n" \
+            "       %prog [-r] < colors"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-r', '--reverse', action='store_true', default=False,
+                      help='convert HSL to RGB hex')
+    options, args = parser.parse_args()
+
+    if not args:
+        convert_stream(sys.stdin, sys.stdout, options.reverse)
+    elif options.reverse:
+        if len(args) != 3:
+            parser.error('-r takes hue, saturation and lightness')
+        h,s,l = [float(a) for a in args]
+        print('{} {} {}: {:02x}{:02x}{:02x}'.format(
+            *(args + hsltorgb(h, s, l))))
+    else:
+        color = args[0]
+        h,s,l = rgbtohsl(color)
+        print('{}: {:>3} {:>3} {:>3}'.format(color, h, s, l))
@@ -1,37 +1,73 @@
 #!/usr/bin/env python
 
 import fnmatch
+import mmap
+import os
+import sqlite3
+import tempfile
+import time
 from datetime import datetime
 from shutil import move
-from random import shuffle, randrange
+from random import shuffle, randrange, seed
 from glob import glob
-from PIL import Image
 
 SCREEN_WIDTH = 1280
 SCREEN_HEIGHT = 800
 DEFAULT_RATIOS = (('full',1,1),('tall',.5,1),('wide',1,.5))
+INDEX_PATH = os.path.expanduser('~/.splitscreenbgs.db')
+INDEX_MAX_AGE = 600 # seconds before a directory glob is rescanned
+INDEX_BATCH = 500 # paths per query, under sqlite's limit on parameters
+# decoded pictures are shared with pool workers through files here
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
 
 class GenerateImageError(Exception):
     pass
 
-def make_bg(file, size, resize_threshhold=3000):
-    im = Image.open(file)
+def make_bg(file, size, resize_threshhold=3000, draft=False):
+    """
+    With ``draft``, JPEGs are decoded at the smallest DCT scale that is
+    still at least the resize target, then resampled the rest of the way.
+    """
+    from PIL import Image
+    return fit_bg(Image.open(file), size, resize_threshhold, draft, file)
+
+def resize_target(im_size, size, resize_threshhold=3000):
+    """
+    The size fit_bg() resizes a picture of ``im_size`` to before cropping,
+    or None if the picture is under the threshhold and only gets cropped.
+    """
+    if im_size[0] < resize_threshhold and im_size[1] < resize_threshhold:
+        return None
+
+    # fit to width (or height if target is tall) before cropping
+    w_ratio = float(size[0])/float(im_size[0])
+    new_height = int(im_size[1] * w_ratio)
+    if new_height >= size[1]:
+        return (size[0], new_height)
+    h_ratio = float(size[1])/float(im_size[1])
+    new_width = int(im_size[0] * h_ratio)
+    if new_width >= size[0]:
+        return (new_width, size[1])
+    return tuple(im_size)
+
+def fit_bg(im, size, resize_threshhold=3000, draft=False, file=None,
+           source_size=None):
+    """
+    Resize and crop an opened image to ``size``. An already loaded image is
+    left untouched, so one decode can be fitted to several sizes. If ``im``
+    was decoded at a reduced scale, ``source_size`` is the picture's real
+    size, so it is resized or cropped just as the full decode would be.
+    """
     if 0 in im.size:
         raise GenerateImageError("Can't read size of {}".format(file))
 
-    # fit to width (or height if target is tall) before cropping
-    if im.size[0] >= resize_threshhold or im.size[1] >= resize_threshhold:
-        w_ratio = float(size[0])/float(im.size[0])
-        new_height = int(im.size[1] * w_ratio)
-        if new_height >= size[1]:
-            new_size = (size[0], new_height)
-        else:
-            h_ratio = float(size[1])/float(im.size[1])
-            new_width = int(im.size[0] * h_ratio)
-            if new_width >= size[0]:
-                new_size = (new_width, size[1])
-            else:
-                new_size = im.size
+    new_size = resize_target(source_size or im.size, size, resize_threshhold)
+    if new_size:
+        if new_size == source_size:
+            new_size = im.size
+        if draft and new_size != im.size:
+            im.draft(im.mode, new_size)
+        from PIL import Image
         try:
             im = im.resize(new_size, Image.ANTIALIAS)
         except Exception as e:
@@ -59,24 +95,240 @@ def make_bg(file, size, resize_threshhold=3000):
 
     return im
 
+def save_bg(spec, new_file, threshhold=None, backup=None, draft=False,
+            decoded=None):
+    """
+    Make and save one background, restoring ``backup`` if the save fails.
+    Returns error messages rather than printing them so that pool workers
+    can be reported in order by the parent. The picture is taken from
+    ``decoded``, a DecodedImage, when given instead of decoding the file.
+    """
+    errors = []
+    try:
+        if decoded:
+            im = fit_bg(decoded.open(), spec['size'], threshhold,
+                        file=spec['file'], source_size=decoded.source_size)
+        else:
+            im = make_bg(spec['file'], spec['size'],
+                         resize_threshhold=threshhold, draft=draft)
+    except GenerateImageError as e:
+        errors.append("\tError generating image: {}".format(e.message))
+    else:
+        try:
+            im.save(new_file)
+        except Exception as e:
+            errors.append(
+                "\tError saving image to {}: {}".format(new_file, e.message))
+            if backup:
+                move(backup, new_file)
+    return errors
+
+def save_bg_star(args):
+    return save_bg(*args)
+
+class DecodedImage(object):
+    """
+    A picture decoded once for every background cut from it. After
+    share() its pixels live in a memory-backed file that pool workers map
+    rather than each decoding the picture or unpickling a copy.
+    """
+    def __init__(self, file, sizes=(), threshhold=None, draft=False):
+        from PIL import Image
+        im = Image.open(file)
+        self.file = file
+        self.source_size = im.size
+        targets = [resize_target(im.size, s, threshhold) for s in sizes]
+        # a reduced decode only works if every background gets resized
+        if draft and targets and None not in targets:
+            im.draft(im.mode, (max(t[0] for t in targets),
+                               max(t[1] for t in targets)))
+        im.load()
+        if im.mode not in ('L', 'RGB'):
+            im = im.convert('RGB')
+        self.image = im
+        self.mode = im.mode
+        self.size = im.size
+        self.path = None
+
+    def share(self, directory=SHARED_DIR):
+        """Move the pixels to shared memory, so this pickles as a name."""
+        fd, self.path = tempfile.mkstemp(prefix='splitscreenbgs-',
+                                         dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.image.tobytes())
+        self.image = None
+        return self
+
+    def open(self):
+        if self.image is None:
+            from PIL import Image
+            with open(self.path, 'rb') as f:
+                pixels = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.image = Image.frombuffer(self.mode, self.size, pixels,
+                                          'raw', self.mode, 0, 1)
+        return self.image
+
+    def close(self):
+        self.image = None
+        if self.path:
+            os.remove(self.path)
+            self.path = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if self.path:
+            state['image'] = None
+        return state
+
+class ImageIndex(object):
+    """
+    Dimensions of source images, stored in sqlite and keyed by path, mtime
+    and file size so only new or changed files are ever opened.
+    """
+    def __init__(self, path=INDEX_PATH, max_age=INDEX_MAX_AGE):
+        self.max_age = max_age
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        columns = [r[1] for r in self.db.execute('pragma table_info(images)')]
+        if columns and 'dirname' not in columns:
+            # made before directories were stored; it's only a cache
+            self.db.executescript(
+                'drop table images; drop table if exists scans;')
+        self.db.executescript("""
+            create table if not exists images (
+                path text primary key,
+                dirname text,
+                mtime real,
+                bytes integer,
+                width integer,
+                height integer
+            );
+            create index if not exists images_dir
+                on images (dirname, width, height);
+            create table if not exists scans (
+                search text primary key,
+                scanned real
+            );
+        """)
+
+    def _read_size(self, path):
+        from PIL import Image
+        try:
+            return Image.open(path).size
+        except IOError:
+            return (0, 0) # never chosen, retried once the file changes
+
+    def _sync(self, paths, known):
+        rows = []
+        for p in paths:
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            if known.get(p) != (st.st_mtime, st.st_size):
+                w, h = self._read_size(p)
+                rows.append((p, st.st_mtime, st.st_size, w, h))
+        if rows: # even an empty executemany opens a write transaction
+            self.db.executemany(
+                'insert or replace into images values (?, ?, ?, ?, ?, ?)',
+                [(r[0], os.path.dirname(r[0])) + r[1:] for r in rows])
+        return rows
+
+    def refresh(self, search, force=False):
+        now = time.time()
+        row = self.db.execute('select scanned from scans where search = ?',
+                              (search,)).fetchone()
+        if row and not force and now - row[0] < self.max_age:
+            return
+
+        # sqlite's glob lets * match /, so the directory is compared on its
+        # own to keep out subdirectories, as glob() does
+        on_disk = glob(search)
+        known = dict(
+            (r[0], (r[1], r[2])) for r in self.db.execute(
+                'select path, mtime, bytes from images'
+                ' where dirname = ? and path glob ?',
+                (os.path.dirname(search), search))
+        )
+        self._sync(on_disk, known)
+        gone = set(known) - set(on_disk)
+        self.db.executemany('delete from images where path = ?',
+                            [(p,) for p in gone])
+        self.db.execute('insert or replace into scans values (?, ?)',
+                        (search, now))
+        self.db.commit()
+
+    def size(self, path):
+        row = self.db.execute(
+            'select mtime, bytes, width, height from images where path = ?',
+            (path,)).fetchone()
+        known = {path: row[:2]} if row else {}
+        synced = self._sync([path], known)
+        if synced:
+            self.db.commit()
+            return synced[0][3:]
+        return row[2:] if row else None
+
+    def sizes(self, paths):
+        paths = list(paths)
+        known = {}
+        found = {}
+        for i in range(0, len(paths), INDEX_BATCH):
+            batch = paths[i:i + INDEX_BATCH]
+            for r in self.db.execute(
+                    'select path, mtime, bytes, width, height from images'
+                    ' where path in ({})'.format(','.join('?' * len(batch))),
+                    batch):
+                known[r[0]] = r[1:3]
+                found[r[0]] = r[3:]
+        for r in self._sync(paths, known):
+            found[r[0]] = r[3:]
+        self.db.commit()
+        return dict((p, found[p]) for p in paths if p in found)
+
+    def choose(self, search, min_width, min_height):
+        self.refresh(search)
+        while True:
+            row = self.db.execute(
+                'select path, mtime, bytes from images'
+                ' where dirname = ? and width >= ? and height >= ?'
+                ' and path glob ? order by random() limit 1',
+                (os.path.dirname(search), min_width, min_height,
+                 search)).fetchone()
+            if not row:
+                return None
+            path = row[0]
+            if not os.path.exists(path):
+                self.db.execute('delete from images where path = ?', (path,))
+                self.db.commit()
+            elif not self._sync([path], {path: row[1:]}):
+                return path
+            else:
+                self.db.commit() # changed on disk, check its new size
+
+_index = None
+
+def get_index():
+    global _index
+    if _index is None:
+        _index = ImageIndex()
+    return _index
+
 def choose_pic(directory, min_width, min_height, pattern=None):
     search = pattern or '{}/*.jpg'
-    if hasattr(directory, '__iter__'):
-        _pix = fnmatch.filter(directory, search.format('*'))
-    else:
-        _pix = glob(search.format(directory))
+    index = get_index()
+    if not hasattr(directory, '__iter__'):
+        return index.choose(search.format(directory), min_width, min_height)
 
-    pix = _pix[:]
+    sizes = index.sizes(fnmatch.filter(directory, search.format('*')))
+    pix = [p for p, size in sizes.items()
+           if size[0] >= min_width and size[1] >= min_height]
     shuffle(pix)
-
-    for p in pix:
-        size = Image.open(p).size
-        if size[0] >= min_width and size[1] >= min_height:
-            return p
+    return pix[0] if pix else None
 
 def get_specs(directory, tot_width, tot_height, ratios=None, pattern=None):
     search = pattern or '{}/*.jpg'
-    pix = glob(search.format(directory))
+    get_index().refresh(search.format(directory))
 
     if not ratios:
        ratios = DEFAULT_RATIOS
@@ -88,7 +340,7 @@ def get_specs(directory, tot_width, tot_height, ratios=None, pattern=None):
         specs.update({
             prefix: {
                 'size': (width, height),
-                'file': choose_pic(pix, width, height, pattern),
+                'file': choose_pic(directory, width, height, pattern),
             }
         })
 
@@ -98,31 +350,123 @@ def get_size_from_image(name, directory, pattern='{}/{}.jpg'):
     search = pattern.format(directory, name)
     matches = glob(search)
     if matches:
-        sample = matches[0]
-        size = Image.open(sample).size
-        return size if 0 not in size else None
+        size = get_index().size(matches[0])
+        return size if size and 0 not in size else None
     else:
         print('No images matching {}'.format(search))
         return None
 
-def list_sizes(out_dir):
+def size_lines(out_dir):
         p = glob('{}/*.jpg'.format(out_dir))
         get_basename = lambda x: x.split('/')[-1].split('.')[0]
         names = [get_basename(pic) for pic in p]
         sizes = sorted(set(names))
         for s in sizes:
             primary = '{}/{}.jpg'.format(out_dir, s)
-            if primary in p:
-                im  = Image.open(primary)
-                w, h = im.size
+            size = primary in p and get_index().size(primary)
+            if size and 0 not in size:
+                w, h = size
                 ratio = float(w)/float(h)
             else:
                 w = h = ''
                 ratio = 0
-            print('{:>4}x{:<4} {:1.2f} {}'.format(w, h, ratio, s))
+            yield '{:>4}x{:<4} {:1.2f} {}'.format(w, h, ratio, s)
+
+def list_sizes(out_dir):
+    for line in size_lines(out_dir):
+        print(line)
+
+def generate(read_dir, out_dir, prefixes, ratios, tot_width=SCREEN_WIDTH,
+             tot_height=SCREEN_HEIGHT, file_name=None, threshhold=None,
+             backup=False, draft=False, pool=None):
+    """
+    Pick a picture for each of ``prefixes`` and write its background to
+    out_dir, yielding progress and error lines in prefix order. With a
+    multiprocessing ``pool`` the prefixes are rendered in its workers.
+    """
+    images = get_specs(read_dir, tot_width, tot_height, ratios)
+
+    if not images:
+        yield 'No suitable images in {}'.format(read_dir)
+        return
+
+    # a picture used by several prefixes is decoded once for all of them,
+    # one used once is decoded by whichever worker renders it
+    sizes = {}
+    for k in prefixes:
+        spec = images.get(k)
+        if spec and spec['file']:
+            sizes.setdefault(spec['file'], []).append(spec['size'])
+    left = dict((f, len(s)) for f, s in sizes.items() if len(s) > 1)
+    decoded = {}
+
+    def decode(file):
+        try:
+            d = DecodedImage(file, sizes[file], threshhold, draft)
+        except IOError:
+            return False # save_bg tries again and reports it
+        return d.share() if pool else d
+
+    num_images = len(prefixes)
+    tasks = []
+    for k in prefixes:
+        if file_name and num_images > 1:
+            basename = '{}-{}'.format(k, file_name)
+        else:
+            basename = file_name or '{}.jpg'.format(k)
+        messages = ["Generating {}".format(basename)]
+
+        spec = images.get(k)
+        new_file = '{}/{}'.format(out_dir,basename)
+        now = datetime.now().strftime('%Y%m%d%H%I%S')
+
+        backup_file = None
+        if backup:
+            backup_file = '{}/{}.{}.{}'.format(out_dir, k, now, basename)
+            try:
+                move(new_file, backup_file)
+            except:
+                messages.append(
+                    "\tError creating backup file {}".format(backup_file))
+
+        tasks.append((messages, spec and spec['file'],
+                      (spec, new_file, threshhold, backup_file, draft)))
+
+    try:
+        results = None
+        if pool:
+            for file in left:
+                decoded[file] = decode(file)
+            results = pool.imap(save_bg_star,
+                                [args + (decoded.get(file) or None,)
+                                 for messages, file, args in tasks])
+
+        # report in prefix order regardless of which worker finishes first
+        for messages, file, args in tasks:
+            for m in messages:
+                yield m
+            if results:
+                errors = results.next()
+            else:
+                if file in left and file not in decoded:
+                    decoded[file] = decode(file)
+                errors = save_bg(*args + (decoded.get(file) or None,))
+            for e in errors:
+                yield e
+            # the last background from a shared decode is done, free it
+            if file in left:
+                left[file] -= 1
+                if not left[file] and decoded.get(file):
+                    decoded.pop(file).close()
+    finally:
+        for d in decoded.values():
+            if d:
+                d.close()
 
 if __name__ == '__main__':
+    import bgdaemon
     from subprocess import Popen, PIPE
+    from multiprocessing import Pool
     from optparse import OptionParser, OptionGroup
     usage = "Usage: %prog [options] picture_dir out_dir"
     parser = OptionParser(usage=usage)
@@ -133,6 +477,9 @@ if __name__ == '__main__':
     parser.add_option('-t', '--threshhold', type='int',
                       help="Width or height beyond which image should be resized"
                            " instead of cropped")
+    parser.add_option('-d', '--draft', action='store_true',
+                      help="Decode large JPEGs at reduced scale before"
+                           " resizing. Faster, slightly softer.")
     parser.add_option('-b', '--backup', action='store_true',
                       help="Create backup of existing file.")
     parser.add_option('-p', '--prefixes',
@@ -140,6 +487,14 @@ if __name__ == '__main__':
                       default='full')
     parser.add_option('-l', '--list', action='store_true',
                       help="List current sizes in out_dir")
+    parser.add_option('-j', '--jobs', type='int', default=1,
+                      help="Generate prefixes in this many worker processes")
+    parser.add_option('--no-daemon', action='store_true',
+                      help="Generate in this process even if bgdaemon.py is"
+                           " running")
+    parser.add_option('--reindex', action='store_true',
+                      help="Rescan picture_dir for new or changed images"
+                           " even if the size index is recent")
     parser.add_option('-c', '--custom', action='store_true',
                       help="Create a single size with ratios specified in"
                            " custom size options")
@@ -161,9 +516,17 @@ if __name__ == '__main__':
     read_dir, out_dir = args
 
     if options.list:
-        list_sizes(out_dir)
+        reply = not options.no_daemon and bgdaemon.call(
+            'list', out_dir=os.path.abspath(out_dir))
+        if reply:
+            print('\n'.join(reply['lines']))
+        else:
+            list_sizes(out_dir)
         exit()
 
+    if options.reindex:
+        get_index().refresh('{}/*.jpg'.format(read_dir), force=True)
+
     ratios = None
     if options.custom:
         if options.width < 0 or options.width > 1 \
@@ -187,45 +550,27 @@ if __name__ == '__main__':
             else:
                 print("Error: can't get size for {}".format(s))
 
-    images = get_specs(read_dir, options.tot_width, options.tot_height, ratios)
-
-    if not images:
-        print 'No suitable images in {}'.format(read_dir)
-        exit()
-
-    num_images = len(prefixes)
-    for k in prefixes:
-        im = None # otherwise if error prev size is saved as current size
-
-        if options.file_name and num_images > 1:
-            basename = '{}-{}'.format(k, options.file_name)
-        else:
-            basename = options.file_name or '{}.jpg'.format(k)
-        print("Generating {}".format(basename))
-
-        spec = images.get(k)
-        new_file = '{}/{}'.format(out_dir,basename)
-        now = datetime.now().strftime('%Y%m%d%H%I%S')
-
-        backup = None
-        if options.backup:
-            backup = '{}/{}.{}.{}'.format(out_dir, k, now, basename)
-            try:
-                move(new_file, backup)
-            except:
-                print("\tError creating backup file {}".format(backup))
-
-        try:
-            im = make_bg(spec['file'], spec['size'],
-                         resize_threshhold=options.threshhold)
-        except GenerateImageError as e:
-            print("\tError generating image: {}".format(e.message))
-        else:
-            try:
-                im.save(new_file)
-            except Exception as e:
-                print("\tError saving image to {}: {}".format(new_file, e.message))
-                if backup:
-                    move(backup, new_file)
-
-
+    # wait however long generating takes, a fallback would do it twice
+    reply = not options.no_daemon and bgdaemon.call(
+        'generate', timeout=None, args=(os.path.abspath(read_dir), os.path.abspath(out_dir),
+                          prefixes, ratios,
+                          options.tot_width, options.tot_height,
+                          options.file_name, options.threshhold,
+                          options.backup, options.draft))
+    pool = None
+    if reply:
+        lines = reply['lines'] if 'lines' in reply else [reply['error']]
+    else:
+        if options.jobs > 1:
+            pool = Pool(options.jobs, initializer=seed)
+        lines = generate(read_dir, out_dir, prefixes, ratios,
+                         options.tot_width, options.tot_height,
+                         options.file_name, options.threshhold,
+                         options.backup, options.draft, pool)
+    try:
+        for line in lines:
+            print(line)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
@@ -1,137 +1,131 @@
 #!/usr/bin/env python
 
-fgtpl = "[38;5;{color}m{text:>4}[m"
-bgtpl = "[48;5;{color}m [30m{text:>3} [m"
+import os
+import sys
+from optparse import OptionParser
 
-fgs = []
-bgs = []
+CACHE_DIR = os.path.expanduser('~/.x256')
 
-for color in range(0,256):
-    kwargs = {'color': color, 'text': color}
-    fgs.append(fgtpl.format(**kwargs))
-    bgs.append(bgtpl.format(**kwargs))
+fgtpl = "\033[38;5;{color}m{text:>4}\033[m"
+bgtpl = "\033[48;5;{color}m \033[30m{text:>3} \033[m"
+CELL_WIDTHS = {'fg': 4, 'bg': 5}
 
+_hsl = None
 
-tpl = """
-{16} {232}{233}{234}{235}{236}{237}{238} {239}{240}
-{59} {241}{242}{243}{244}{102} {245}{246}{247}{248}
-{145}{249}{250}{251} {252}{253}{188}{254}{255}{231}
+def hsl(color):
+    """rgbtohsl() of a palette index, for all 256 at once on first use."""
+    global _hsl
+    if _hsl is None:
+        from colorize import PALETTE
+        from rgbtohsl import rgbtohsl
+        _hsl = [rgbtohsl('{:02x}{:02x}{:02x}'.format(*rgb)) for rgb in PALETTE]
+    return _hsl[color]
 
-{52} {88}  {124} {160} {196} |{203}|{167}|{131}|{95} |{138}|{181}|{224}|{217}|{174}|{210}|{203}|
-{52} {88}  {124} {160} {196} |{209}|{167}|{131}|{95} |{138}|{181}|{224}|{217}|{174}|{210}|{209}|
-{52} {88}  {124} {160} {196} |{209}|{173}|{131}|{95} |{138}|{181}|{224}|{217}|{174}|{210}|{209}|
-{52} {88}  {124} {160} {196} |{209}|{173}|{131}|{95} |{138}|{181}|{224}|{217}|{174}|{216}|{209}|
-{52} {88}  {124} {160} {202} |{209}|{173}|{131}|{95} |{138}|{181}|{224}|{217}|{174}|{216}|{209}|
-{52} {88}  {124} {166} {202} |{209}|{173}|{131}|{95} |{138}|{181}|{224}|{217}|{174}|{216}|{209}|
-{52} {88}  {124} {166} {202} |{209}|{173}|{131}|{95} |{138}|{181}|{224}|{217}|{180}|{216}|{209}|
-{52} {88}  {124} {166} {202} |{215}|{173}|{137}|{95} |{138}|{181}|{224}|{217}|{180}|{216}|{215}|
-{52} {88}  {124} {166} {208} |{215}|{173}|{137}|{95} |{138}|{181}|{224}|{217}|{180}|{216}|{215}|
-{52} {88}  {130} {166} {208} |{215}|{173}|{137}|{95} |{138}|{181}|{224}|{217}|{180}|{216}|{215}|
-{52} {88}  {130} {172} {208} |{215}|{173}|{137}|{95} |{138}|{181}|{224}|{223}|{180}|{216}|{215}|
-{52} {88}  {130} {172} {208} |{215}|{179}|{137}|{95} |{138}|{181}|{224}|{223}|{180}|{216}|{215}|
-{52} {88}  {130} {172} {214} |{215}|{179}|{137}|{95} |{138}|{181}|{224}|{223}|{180}|{216}|{215}|
-{52} {94}  {130} {172} {214} |{215}|{179}|{137}|{95} |{138}|{181}|{224}|{223}|{180}|{216}|{215}|
-{52} {94}  {130} {172} {214} |{215}|{179}|{137}|{95} |{138}|{181}|{224}|{223}|{180}|{222}|{215}|
-{52} {94}  {136} {172} {214} |{215}|{179}|{137}|{95} |{138}|{181}|{224}|{223}|{180}|{222}|{215}|
-{52} {94}  {136} {178} {214} |{215}|{179}|{137}|{95} |{138}|{181}|{224}|{223}|{180}|{222}|{215}|
-{52} {94}  {136} {178} {214} |{221}|{179}|{137}|{95} |{138}|{181}|{224}|{223}|{180}|{222}|{221}|
-{52} {94}  {136} {178} {220} |{221}|{179}|{137}|{95} |{138}|{181}|{224}|{223}|{180}|{222}|{221}|
-{58} {100} {142} {184} {226} |{227}|{185}|{143}|{101}|{144}|{187}|{230}|{229}|{186}|{228}|{227}|
-{58} {100} {142} {184} {190} |{227}|{185}|{143}|{101}|{144}|{187}|{230}|{229}|{186}|{228}|{227}|
-{58} {100} {142} {148} {190} |{191}|{185}|{143}|{101}|{144}|{187}|{230}|{229}|{186}|{228}|{191}|
-{58} {100} {106} {148} {190} |{191}|{185}|{143}|{101}|{144}|{187}|{230}|{229}|{186}|{228}|{191}|
-{58} {100} {106} {148} {190} |{191}|{185}|{143}|{101}|{144}|{187}|{230}|{229}|{186}|{192}|{191}|
-{58} {64}  {106} {148} {190} |{191}|{185}|{143}|{101}|{144}|{187}|{230}|{229}|{186}|{192}|{191}|
-{58} {64}  {106} {148} {154} |{191}|{185}|{143}|{101}|{144}|{187}|{230}|{229}|{186}|{192}|{191}|
-{58} {64}  {106} {148} {154} |{191}|{149}|{143}|{101}|{144}|{187}|{230}|{229}|{186}|{192}|{191}|
-{58} {64}  {106} {112} {154} |{191}|{149}|{143}|{101}|{144}|{187}|{230}|{193}|{186}|{192}|{191}|
-{58} {64}  {70}  {112} {154} |{191}|{149}|{143}|{101}|{144}|{187}|{230}|{193}|{186}|{192}|{191}|
-{58} {64}  {70}  {112} {118} |{191}|{149}|{143}|{101}|{144}|{187}|{230}|{193}|{186}|{192}|{191}|
-{58} {64}  {70}  {112} {118} |{155}|{149}|{107}|{101}|{144}|{187}|{230}|{193}|{186}|{192}|{155}|
-{58} {64}  {70}  {112} {118} |{155}|{149}|{107}|{101}|{144}|{187}|{230}|{193}|{150}|{192}|{155}|
-{58} {64}  {70}  {76}  {118} |{155}|{149}|{107}|{101}|{144}|{187}|{230}|{193}|{150}|{192}|{155}|
-{58} {64}  {70}  {76}  {82}  |{155}|{149}|{107}|{101}|{144}|{187}|{230}|{193}|{150}|{192}|{155}|
-{58} {64}  {70}  {76}  {82}  |{155}|{149}|{107}|{101}|{144}|{187}|{230}|{193}|{150}|{156}|{155}|
-{58} {64}  {70}  {76}  {82}  |{155}|{113}|{107}|{101}|{144}|{187}|{230}|{193}|{150}|{156}|{155}|
-{58} {64}  {70}  {76}  {82}  |{119}|{113}|{107}|{101}|{144}|{187}|{230}|{193}|{150}|{156}|{119}|
-{22} {28}  {34}  {40}  {46}  |{83} |{77} |{71} |{65} |{108}|{151}|{194}|{157}|{114}|{120}|{83} |
-{22} {28}  {34}  {40}  {46}  |{84} |{77} |{71} |{65} |{108}|{151}|{194}|{157}|{114}|{120}|{84} |
-{22} {28}  {34}  {40}  {46}  |{84} |{78} |{71} |{65} |{108}|{151}|{194}|{157}|{114}|{120}|{84} |
-{22} {28}  {34}  {40}  {46}  |{84} |{78} |{71} |{65} |{108}|{151}|{194}|{157}|{114}|{121}|{84} |
-{22} {28}  {34}  {40}  {47}  |{84} |{78} |{71} |{65} |{108}|{151}|{194}|{157}|{114}|{121}|{84} |
-{22} {28}  {34}  {41}  {47}  |{84} |{78} |{71} |{65} |{108}|{151}|{194}|{157}|{114}|{121}|{84} |
-{22} {28}  {34}  {41}  {47}  |{84} |{78} |{71} |{65} |{108}|{151}|{194}|{157}|{115}|{121}|{84} |
-{22} {28}  {34}  {41}  {47}  |{85} |{78} |{72} |{65} |{108}|{151}|{194}|{157}|{115}|{121}|{85} |
-{22} {28}  {34}  {41}  {48}  |{85} |{78} |{72} |{65} |{108}|{151}|{194}|{157}|{115}|{121}|{85} |
-{22} {28}  {35}  {41}  {48}  |{85} |{78} |{72} |{65} |{108}|{151}|{194}|{157}|{115}|{121}|{85} |
-{22} {28}  {35}  {42}  {48}  |{85} |{78} |{72} |{65} |{108}|{151}|{194}|{158}|{115}|{121}|{85} |
-{22} {28}  {35}  {42}  {48}  |{85} |{79} |{72} |{65} |{108}|{151}|{194}|{158}|{115}|{121}|{85} |
-{22} {28}  {35}  {42}  {49}  |{85} |{79} |{72} |{65} |{108}|{151}|{194}|{158}|{115}|{121}|{85} |
-{22} {29}  {35}  {42}  {49}  |{85} |{79} |{72} |{65} |{108}|{151}|{194}|{158}|{115}|{121}|{85} |
-{22} {29}  {35}  {42}  {49}  |{85} |{79} |{72} |{65} |{108}|{151}|{194}|{158}|{115}|{122}|{85} |
-{22} {29}  {36}  {42}  {49}  |{85} |{79} |{72} |{65} |{108}|{151}|{194}|{158}|{115}|{122}|{85} |
-{22} {29}  {36}  {43}  {49}  |{86} |{79} |{72} |{65} |{108}|{151}|{194}|{158}|{115}|{122}|{86} |
-{22} {29}  {36}  {43}  {50}  |{86} |{79} |{72} |{65} |{108}|{151}|{194}|{158}|{115}|{122}|{86} |
-{23} {30}  {37}  {44}  {51}  |{87} |{80} |{73} |{66} |{109}|{152}|{195}|{159}|{116}|{123}|{87} |
-{23} {30}  {37}  {44}  {45}  |{87} |{80} |{73} |{66} |{109}|{152}|{195}|{159}|{116}|{123}|{87} |
-{23} {30}  {37}  {38}  {45}  |{81} |{80} |{73} |{66} |{109}|{152}|{195}|{159}|{116}|{123}|{81} |
-{23} {30}  {31}  {38}  {45}  |{81} |{80} |{73} |{66} |{109}|{152}|{195}|{159}|{116}|{123}|{81} |
-{23} {30}  {31}  {38}  {45}  |{81} |{80} |{73} |{66} |{109}|{152}|{195}|{159}|{116}|{117}|{81} |
-{23} {24}  {31}  {38}  {45}  |{81} |{80} |{73} |{66} |{109}|{152}|{195}|{159}|{116}|{117}|{81} |
-{23} {24}  {31}  {38}  {39}  |{81} |{80} |{73} |{66} |{109}|{152}|{195}|{159}|{116}|{117}|{81} |
-{23} {24}  {31}  {38}  {39}  |{81} |{74} |{73} |{66} |{109}|{152}|{195}|{159}|{116}|{117}|{81} |
-{23} {24}  {31}  {32}  {39}  |{81} |{74} |{73} |{66} |{109}|{152}|{195}|{159}|{116}|{117}|{81} |
-{23} {24}  {31}  {32}  {39}  |{81} |{74} |{73} |{66} |{109}|{152}|{195}|{153}|{116}|{117}|{81} |
-{23} {24}  {25}  {32}  {39}  |{81} |{74} |{73} |{66} |{109}|{152}|{195}|{153}|{116}|{117}|{81} |
-{23} {24}  {25}  {32}  {33}  |{81} |{74} |{73} |{66} |{109}|{152}|{195}|{153}|{116}|{117}|{81} |
-{23} {24}  {25}  {32}  {33}  |{75} |{74} |{67} |{66} |{109}|{152}|{195}|{153}|{116}|{117}|{75} |
-{23} {24}  {25}  {32}  {33}  |{75} |{74} |{67} |{66} |{109}|{152}|{195}|{153}|{110}|{117}|{75} |
-{23} {24}  {25}  {26}  {33}  |{75} |{74} |{67} |{66} |{109}|{152}|{195}|{153}|{110}|{117}|{75} |
-{23} {24}  {25}  {26}  {27}  |{75} |{74} |{67} |{66} |{109}|{152}|{195}|{153}|{110}|{117}|{75} |
-{23} {24}  {25}  {26}  {27}  |{75} |{74} |{67} |{66} |{109}|{152}|{195}|{153}|{110}|{111}|{75} |
-{23} {24}  {25}  {26}  {27}  |{75} |{68} |{67} |{66} |{109}|{152}|{195}|{153}|{110}|{111}|{75} |
-{23} {24}  {25}  {26}  {27}  |{69} |{68} |{67} |{66} |{109}|{152}|{195}|{153}|{110}|{111}|{69} |
-{17} {18}  {19}  {20}  {21}  |{63} |{62} |{61} |{60} |{103}|{146}|{189}|{147}|{104}|{105}|{63} |
-{17} {18}  {19}  {20}  {21}  |{99} |{62} |{61} |{60} |{103}|{146}|{189}|{147}|{104}|{105}|{99} |
-{17} {18}  {19}  {20}  {21}  |{99} |{98} |{61} |{60} |{103}|{146}|{189}|{147}|{104}|{105}|{99} |
-{17} {18}  {19}  {20}  {21}  |{99} |{98} |{61} |{60} |{103}|{146}|{189}|{147}|{104}|{141}|{99} |
-{17} {18}  {19}  {20}  {57}  |{99} |{98} |{61} |{60} |{103}|{146}|{189}|{147}|{104}|{141}|{99} |
-{17} {18}  {19}  {56}  {57}  |{99} |{98} |{61} |{60} |{103}|{146}|{189}|{147}|{104}|{141}|{99} |
-{17} {18}  {19}  {56}  {57}  |{99} |{98} |{61} |{60} |{103}|{146}|{189}|{147}|{140}|{141}|{99} |
-{17} {18}  {19}  {56}  {57}  |{135}|{98} |{97} |{60} |{103}|{146}|{189}|{147}|{140}|{141}|{135}|
-{17} {18}  {19}  {56}  {93}  |{135}|{98} |{97} |{60} |{103}|{146}|{189}|{147}|{140}|{141}|{135}|
-{17} {18}  {55}  {56}  {93}  |{135}|{98} |{97} |{60} |{103}|{146}|{189}|{147}|{140}|{141}|{135}|
-{17} {18}  {55}  {92}  {93}  |{135}|{98} |{97} |{60} |{103}|{146}|{189}|{183}|{140}|{141}|{135}|
-{17} {18}  {55}  {92}  {93}  |{135}|{134}|{97} |{60} |{103}|{146}|{189}|{183}|{140}|{141}|{135}|
-{17} {18}  {55}  {92}  {129} |{135}|{134}|{97} |{60} |{103}|{146}|{189}|{183}|{140}|{141}|{135}|
-{17} {54}  {55}  {92}  {129} |{135}|{134}|{97} |{60} |{103}|{146}|{189}|{183}|{140}|{141}|{135}|
-{17} {54}  {55}  {92}  {129} |{135}|{134}|{97} |{60} |{103}|{146}|{189}|{183}|{140}|{177}|{135}|
-{17} {54}  {91}  {92}  {129} |{135}|{134}|{97} |{60} |{103}|{146}|{189}|{183}|{140}|{177}|{135}|
-{17} {54}  {91}  {128} {129} |{135}|{134}|{97} |{60} |{103}|{146}|{189}|{183}|{140}|{177}|{135}|
-{17} {54}  {91}  {128} {129} |{171}|{134}|{97} |{60} |{103}|{146}|{189}|{183}|{140}|{177}|{171}|
-{17} {54}  {91}  {128} {165} |{171}|{134}|{97} |{60} |{103}|{146}|{189}|{183}|{140}|{177}|{171}|
-{53} {90}  {127} {164} {201} |{207}|{170}|{133}|{96} |{139}|{182}|{225}|{219}|{176}|{213}|{207}|
-{53} {90}  {127} {164} {200} |{207}|{170}|{133}|{96} |{139}|{182}|{225}|{219}|{176}|{213}|{207}|
-{53} {90}  {127} {163} {200} |{206}|{170}|{133}|{96} |{139}|{182}|{225}|{219}|{176}|{213}|{206}|
-{53} {90}  {126} {163} {200} |{206}|{170}|{133}|{96} |{139}|{182}|{225}|{219}|{176}|{213}|{206}|
-{53} {90}  {126} {163} {200} |{206}|{170}|{133}|{96} |{139}|{182}|{225}|{219}|{176}|{212}|{206}|
-{53} {89}  {126} {163} {200} |{206}|{170}|{133}|{96} |{139}|{182}|{225}|{219}|{176}|{212}|{206}|
-{53} {89}  {126} {163} {199} |{206}|{170}|{133}|{96} |{139}|{182}|{225}|{219}|{176}|{212}|{206}|
-{53} {89}  {126} {163} {199} |{206}|{169}|{133}|{96} |{139}|{182}|{225}|{219}|{176}|{212}|{206}|
-{53} {89}  {126} {162} {199} |{206}|{169}|{133}|{96} |{139}|{182}|{225}|{219}|{176}|{212}|{206}|
-{53} {89}  {126} {162} {199} |{206}|{169}|{133}|{96} |{139}|{182}|{225}|{218}|{176}|{212}|{206}|
-{53} {89}  {125} {162} {199} |{206}|{169}|{133}|{96} |{139}|{182}|{225}|{218}|{176}|{212}|{206}|
-{53} {89}  {125} {162} {198} |{206}|{169}|{133}|{96} |{139}|{182}|{225}|{218}|{176}|{212}|{206}|
-{53} {89}  {125} {162} {198} |{205}|{169}|{132}|{96} |{139}|{182}|{225}|{218}|{176}|{212}|{205}|
-{53} {89}  {125} {162} {198} |{205}|{169}|{132}|{96} |{139}|{182}|{225}|{218}|{175}|{212}|{205}|
-{53} {89}  {125} {161} {198} |{205}|{169}|{132}|{96} |{139}|{182}|{225}|{218}|{175}|{212}|{205}|
-{53} {89}  {125} {161} {197} |{205}|{169}|{132}|{96} |{139}|{182}|{225}|{218}|{175}|{212}|{205}|
-{53} {89}  {125} {161} {197} |{205}|{169}|{132}|{96} |{139}|{182}|{225}|{218}|{175}|{211}|{205}|
-{53} {89}  {125} {161} {197} |{205}|{168}|{132}|{96} |{139}|{182}|{225}|{218}|{175}|{211}|{205}|
-{53} {89}  {125} {161} {197} |{204}|{168}|{132}|{96} |{139}|{182}|{225}|{218}|{175}|{211}|{204}|
-"""
+def by_cube():
+    """System colors, the 6x6x6 cube in index order, then the grays."""
+    return [range(0, 16), range(16, 232), range(232, 256)]
 
-tpl = tpl.replace(' ', '').replace('|','')
+def by_hue():
+    """
+    Colors sorted by hue, then saturation and lightness, with the
+    achromatic ones (system grays included) after them by lightness.
+    """
+    colors = [c for c in range(256) if hsl(c)[1]]
+    grays = [c for c in range(256) if not hsl(c)[1]]
+    return [sorted(colors, key=hsl), sorted(grays, key=lambda c: hsl(c)[2])]
 
-print tpl.format(*bgs, sp=' '*5)
-print tpl.format(*fgs, sp=' '*4)
+def by_lightness():
+    """Every color by lightness, then hue and saturation."""
+    key = lambda c: (hsl(c)[2], hsl(c)[0], hsl(c)[1])
+    return [sorted(range(256), key=key)]
+
+# layout name: (sections of colors, row lengths are kept a multiple of this)
+LAYOUTS = {
+    'cube': (by_cube, 6),
+    'hue': (by_hue, 1),
+    'lightness': (by_lightness, 1),
+}
+
+def terminal_width(default=80):
+    try:
+        return int(os.environ['COLUMNS'])
+    except (KeyError, ValueError):
+        pass
+    try:
+        import fcntl
+        import struct
+        import termios
+        rows, cols = struct.unpack('hh', fcntl.ioctl(sys.stdout.fileno(),
+                                   termios.TIOCGWINSZ, '    '))
+        return cols or default
+    except (ImportError, IOError):
+        return default
+
+def render(layout='hue', width=80, modes=('bg', 'fg')):
+    """
+    The palette as text: for each of ``modes`` the sections of ``layout``
+    wrapped into as many cells as fit in ``width``, a blank line between
+    sections.
+    """
+    sections, unit = LAYOUTS[layout]
+    sections = sections()
+    out = []
+    for mode in modes:
+        tpl = fgtpl if mode == 'fg' else bgtpl
+        cells = [tpl.format(color=c, text=c) for c in range(256)]
+        columns = max(unit, width // CELL_WIDTHS[mode] // unit * unit)
+        for section in sections:
+            out.append('')
+            for i in range(0, len(section), columns):
+                out.append(''.join(cells[c] for c in section[i:i + columns]))
+    return '\n'.join(out) + '\n'
+
+def cached_render(layout='hue', width=80, modes=('bg', 'fg'),
+                  cache_dir=CACHE_DIR):
+    """
+    render(), kept in ``cache_dir`` per layout, width and modes. Entries
+    older than this file are rebuilt, so layout changes show up.
+    """
+    path = os.path.join(cache_dir, '{}-{}-{}'.format(layout, width,
+                                                     '-'.join(modes)))
+    try:
+        if os.path.getmtime(path) >= os.path.getmtime(__file__):
+            with open(path, 'rb') as f:
+                return f.read()
+    except OSError:
+        pass
+
+    text = render(layout, width, modes)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp = '{}.{}'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(text)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        pass
+    return text
+
+if __name__ == '__main__':
+    usage = "Usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-l', '--layout', choices=sorted(LAYOUTS),
+                      default='hue',
+                      help='order colors by hue (default), lightness or cube')
+    parser.add_option('-w', '--width', type='int',
+                      help='columns to fill, defaults to the terminal width')
+    parser.add_option('-m', '--mode', choices=['bg', 'fg', 'both'],
+                      default='both',
+                      help='show colors as backgrounds, foregrounds or both')
+    parser.add_option('-n', '--no-cache', action='store_true', default=False,
+                      help='render again instead of using the cache')
+    options, args = parser.parse_args()
+
+    width = options.width or terminal_width()
+    modes = ('bg', 'fg') if options.mode == 'both' else (options.mode,)
+    if options.no_cache:
+        text = render(options.layout, width, modes)
+    else:
+        text = cached_render(options.layout, width, modes)
+    sys.stdout.write(text)